@@ -38,7 +38,8 @@ setup(
     license = 'Apache License 2.0',
     keywords = 'foreman automation',
     url = 'http://github.com/lzoubek/uberforeman',
-    install_requires=['requests>=1.2.0'],
+    install_requires=['requests>=1.2.0','futures; python_version < "3"'],
+    extras_require={'async':['aiohttp']},
     data_files = [],
     package_data = {'': ['*.txt',
                          'examples/*.py',
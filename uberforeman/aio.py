@@ -0,0 +1,375 @@
+"""This module contains asyncio based engine driving lifecycle of setup hosts from single event loop.
+
+Engine is selected by ``--engine async`` and requires python 3.5+ and aiohttp. Setup is loaded
+and validated by Uberforeman as usual, only install/start/stop/destroy/enableBuild run here.
+Readiness of hosts is probed by JonBCHostReady of Uberforeman, its futures are awaited here.
+"""
+import asyncio, json, time
+from urllib.parse import quote
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .scheduler import CREATED, DONE, DependencyException
+from .util import TaskResult
+from .controller import CancelledException
+from .limiter import isOverload, retryAfter
+from .retry import failureReason, UNCERTAIN
+from .trace import tracer, tracedPhase, requestName, HOST, HTTP, WAIT
+from . import journal
+
+# max number of concurrent requests to foreman
+FOREMAN_CONCURRENCY = 20
+
+class AsyncResponse(object):
+    """Response of AsyncForemanClient, provides subset of requests.Response API"""
+
+    def __init__(self,status_code,text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class AsyncForemanClient(object):
+    """Async counterpart of ForemanClient lifecycle calls, shares URL and credentials with it"""
+
+    def __init__(self,foreman,session,limit=FOREMAN_CONCURRENCY):
+        """Creates new instance
+
+        :param foreman: ForemanClient instance
+        :param session: aiohttp.ClientSession
+        :param limit: max number of concurrent requests
+        """
+        self.foreman = foreman
+        self.session = session
+        self.semaphore = asyncio.Semaphore(limit)
+        self.auth = aiohttp.BasicAuth(*foreman.auth)
+        self.retry = foreman.retry
+
+    async def request(self,method,resource,data=None,verify=None):
+        """Sends request, transient failures are retried according to RetryPolicy of ForemanClient"""
+        attempt = 0
+        started = time.time()
+        while True:
+            attempt += 1
+            r = error = None
+            try:
+                r = await self._send(method,resource,data)
+                if r.status_code < 400:
+                    return r
+            except (aiohttp.ClientConnectionError,asyncio.TimeoutError) as e:
+                error = e
+            reason = failureReason(r and r.status_code,r and r.status_code == 500 and r.text or '',error)
+            delay = self.retry.next(method,resource,attempt,started,reason,r and r.status_code,error,verify is not None)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return r
+            with tracer.span('retry backoff',WAIT,resource=resource,attempt=attempt):
+                await asyncio.sleep(delay)
+            if verify and reason == UNCERTAIN:
+                created = await verify()
+                if created is not None:
+                    self.retry.log.warning('retry method=%s resource=%s attempt=%d outcome=succeeded',method,resource,attempt)
+                    return created
+
+    async def _send(self,method,resource,data=None):
+        headers = {'accept':'version=2'}
+        body = None
+        if data is not None:
+            headers['Content-type'] = 'application/json'
+            body = json.dumps(data,default=dict)
+        if method != 'GET':
+            self.foreman._modified(resource)
+        # limiter is shared with threads using ForemanClient, it can not block event loop
+        limiter = self.foreman.limiter.forRequest(method,resource)
+        async with self.semaphore:
+            await self._acquire(limiter)
+            t0 = time.time()
+            response = None
+            pause = None
+            try:
+                with tracer.span(requestName(method,resource),HTTP) as args:
+                    async with self.session.request(method,self.foreman._url(resource),data=body,headers=headers,auth=self.auth,ssl=False) as r:
+                        args['status'] = r.status
+                        pause = retryAfter(r.headers)
+                        response = AsyncResponse(r.status,await r.text())
+                        return response
+            finally:
+                limiter.release(time.time() - t0,response is None or isOverload(response.status_code,response.text),pause)
+
+    async def _acquire(self,limiter):
+        """Takes slot of limiter, coroutine is woken up by limiter instead of polling it"""
+        loop = asyncio.get_event_loop()
+        t0 = time.time()
+        waited = False
+        while True:
+            waiting = limiter.acquireOrWait(loop)
+            if waiting is None:
+                break
+            waited = True
+            await waiting
+        if waited:
+            tracer.add('wait limiter (%s)' % limiter.name,WAIT,t0,time.time())
+
+    async def get(self,resource):
+        return (await self.request('GET',resource)).json()
+
+    async def delete(self,resource):
+        return await self.request('DELETE',resource)
+
+    async def post(self,resource,data):
+        return await self.request('POST',resource,data)
+
+    async def put(self,resource,data):
+        return await self.request('PUT',resource,data)
+
+    async def createHost(self,host,fqdn):
+        """Async counterpart of ForemanClient.createHost"""
+        async def created():
+            found = (await self.request('GET','/api/hosts?search=%s' % quote('name ^ (%s)' % fqdn))).json()
+            for h in found.get('results',[]):
+                if h['name'] == fqdn:
+                    return await self.request('GET','/api/hosts/%d' % h['id'])
+        return await self.request('POST','/api/hosts',{'host':host},verify=created)
+
+    async def power(self,host,action='state'):
+        return await self.put('/api/hosts/%d/power' % host,{'power_action':action})
+
+class AsyncEngine(object):
+    """
+    Runs lifecycle actions of Uberforeman from single event loop. Hosts are coroutines waiting
+    for their prerequisites (same dependency graph as thread engine), concurrency of foreman requests
+    and readiness probes is limited by semaphores.
+    """
+    def __init__(self,uberforeman,foremanLimit=FOREMAN_CONCURRENCY):
+        if aiohttp is None:
+            raise Exception('--engine async requires aiohttp, install it first')
+        self.uf = uberforeman
+        self.log = uberforeman.log
+        self.setup = uberforeman.setup
+        self.name = uberforeman.name
+        self.foremanLimit = foremanLimit
+
+    def _loop(self,action,*args):
+        async def main():
+            connector = aiohttp.TCPConnector(limit=self.foremanLimit)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                self.foreman = AsyncForemanClient(self.uf.foreman,session,self.foremanLimit)
+                return await action(*args)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+    async def _isInstalled(self,vm):
+        """Probes host once by readiness probe of Uberforeman, on thread of default executor"""
+        return await asyncio.get_event_loop().run_in_executor(None,self.uf.vmChecker.isInstalled,vm['ip'])
+
+    async def _waitForInstalled(self,vm):
+        """Waits for host to get installed, host is probed by shared ReadinessPoller meanwhile"""
+        await asyncio.wrap_future(self.uf.vmChecker.whenInstalled(vm['ip'],vm['name'],self.uf.cancelled))
+
+    async def _call(self,target,*args):
+        t0 = time.time()
+        try:
+            if self.uf.cancelled.is_set():
+                raise CancelledException('cancelled')
+            with tracer.span(target.__name__.lstrip('_'),HOST,track=args[0]['name']):
+                return TaskResult(args,result=await target(*args),duration=time.time() - t0)
+        except Exception as e:
+            return TaskResult(args,exception=e,duration=time.time() - t0)
+
+    async def _each(self,target):
+        return await asyncio.gather(*[self._call(target,vm) for vm in self.setup['hosts']])
+
+    async def _graph(self,scheduler):
+        """Runs nodes of DependencyScheduler as coroutines, returns list of TaskResult of hosts"""
+        scheduler._check()
+        created = dict((name,asyncio.Event()) for name in scheduler.order)
+        finished = dict((name,asyncio.Event()) for name in scheduler.order)
+        results = {}
+
+        def mark(name,milestone):
+            scheduler.nodes[name]['reached'].add(milestone)
+            created[name].set()
+
+        async def node(name):
+            n = scheduler.nodes[name]
+            t0 = time.time()
+            for dep,milestone in n['deps']:
+                if milestone == CREATED:
+                    await created[dep].wait()
+                else:
+                    await finished[dep].wait()
+                if milestone not in scheduler.nodes[dep]['reached']:
+                    results[name] = TaskResult(n['args'],exception=DependencyException('prerequisite of %s failed' % name))
+                    break
+            else:
+                if n['target'] is None:
+                    results[name] = TaskResult(n['args'],result=True)
+                else:
+                    if n['deps']:
+                        tracer.add('wait prerequisites',WAIT,t0,time.time(),track=name)
+                    results[name] = await self._call(n['target'],*(n['args'] + (mark,)))
+            if results[name].ok:
+                n['reached'].update([CREATED,DONE])
+            created[name].set()
+            finished[name].set()
+
+        await asyncio.gather(*[node(name) for name in scheduler.order])
+        return [results[vm['name']] for vm in self.setup['hosts']]
+
+    async def _installHost(self,vm,mark):
+        if vm['status']['remote'] != None:
+            self.log.info('host %s already exists', vm['name'])
+            return True
+        self.uf._hostParameters(vm)
+        self.log.info('Installing %s ..', vm['name'])
+
+        # orchestration tasks are tracked by shared TaskTracker while foreman creates host
+        uuid = vm['status']['local']['progress_report_id']
+        self.uf.taskTracker.track(uuid,vm['name'])
+        try:
+            r = await self.foreman.createHost(vm['status']['local'],'%s.%s' % (vm['name'],vm['domain']))
+        finally:
+            self.uf.taskTracker.untrack(uuid)
+        if r.status_code != 200:
+            self.log.error('server returned %d : %s',r.status_code,r.text)
+            raise Exception('failed to install host')
+        self.log.info('host %s created in foreman',vm['name'])
+        vm['status']['remote'] = r.json()
+        vm['ip'] = vm['status']['remote']['ip']
+        self.uf._record(vm,journal.CREATED)
+        mark(vm['name'],CREATED)
+        if vm['status']['local']['provision_method'] == 'image':
+            self.log.info('Waiting for %s (image-based) to get installed...', vm['name'])
+            await self._waitForInstalled(vm)
+            self.log.info('Host %s is installed' %vm['name'])
+            self.uf._record(vm,journal.INSTALLED)
+        return True
+
+    async def _install(self):
+        if self.uf.journal and not self.uf.resume:
+            self.uf.journal.clear()
+        results = await self._graph(self.uf._scheduler(self._installHost,references=True))
+        if not self.uf._succeeded(results):
+            self.log.error('Failed to start/install several hosts')
+            return False
+        self.log.info('Setup deployed to foreman')
+        return await self._start()
+
+    @tracedPhase
+    def install(self):
+        self.log.info("Installing setup : %s" % self.name)
+        if len(self.setup['hosts']) == 0:
+            self.log.info('Empty setup?')
+            return
+        self._loop(self._install)
+
+    async def _startHost(self,vm,mark):
+        if vm['status']['remote'] == None:
+            raise Exception('VM %s does not exist in foreman, use --install' % vm['name'])
+        # power state is cheap to check and tells whether journal is still true (host may be stopped meanwhile)
+        power = (await self.foreman.power(vm['status']['remote']['id'],'state')).json()['power']
+        if power != 'up':
+            self.uf._forgetPowerOn(vm)
+        elif self.uf._journaled(vm,journal.INSTALLED):
+            self.log.info('host %s is already installed (journal)', vm['name'])
+            return True
+        installed = await self._isInstalled(vm)
+        if power == 'up' and installed:
+            self.log.info('host %s is already installed', vm['name'])
+            self.uf._record(vm,journal.INSTALLED)
+            return True
+        if power != 'up':
+            self.log.info('Power on %s' %vm['name'])
+            r = await self.foreman.power(vm['status']['remote']['id'],'start')
+            if r.status_code != 200:
+                self.log.error('Failed to start %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+                return
+            self.uf._record(vm,journal.POWERED_ON)
+        self.log.info('Waiting for %s to get installed...', vm['name'])
+        await self._waitForInstalled(vm)
+        self.log.info('Host %s is installed' %vm['name'])
+        self.uf._record(vm,journal.INSTALLED)
+        return True
+
+    async def _start(self):
+        if not self.uf._succeeded(await self._graph(self.uf._scheduler(self._startHost))):
+            self.log.error('Failed to start/install several hosts')
+            return False
+        self.log.info('Setup started')
+        return True
+
+    @tracedPhase
+    def start(self):
+        self.log.info("Starting setup : %s" % self.name)
+        if len(self.setup['hosts']) == 0:
+            self.log.info('Empty setup?')
+            return
+        self._loop(self._start)
+
+    async def _stopHost(self,vm):
+        if vm['status']['remote']:
+            self.log.info('Power of %s' %vm['name'])
+            r = await self.foreman.power(vm['status']['remote']['id'],'stop')
+            if r.status_code != 200:
+                self.log.error('Failed to stop %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+            else:
+                self.log.info('VM %s was stopped', vm['name'])
+                self.uf._forgetPowerOn(vm)
+                return True
+        else:
+            self.log.warn('VM %s does not exist in foreman',vm['name'])
+            # nothing to stop
+            return True
+
+    @tracedPhase
+    def stop(self):
+        self.log.info("Power off setup : %s" % self.name)
+        self.uf._succeeded(self._loop(self._each,self._stopHost))
+        self.log.info('Setup powered off')
+
+    async def _destroyHost(self,vm):
+        if vm['status']['remote']:
+            self.log.info(' Destroying %s' %vm['name'])
+            r = await self.foreman.delete('/api/hosts/%d' % vm['status']['remote']['id'])
+            # 404 means retried DELETE found host already deleted by lost attempt
+            if r.status_code not in (200,404):
+                self.log.error('Failed to destroy %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+                return
+            vm['status']['remote'] = None
+            del vm['ip']
+            if self.uf.journal:
+                self.uf.journal.forget(vm['name'])
+            return True
+        else:
+            self.log.warn('Host %s does not exist in foreman',vm['name'])
+            # nothing to destroy
+            return True
+
+    @tracedPhase
+    def destroy(self):
+        self.log.info('Destroy setup: %s',self.name)
+        self.uf._succeeded(self._loop(self._each,self._destroyHost))
+        self.log.info('Setup destroyed')
+
+    async def _buildHost(self,vm):
+        if vm['status']['remote']:
+            self.log.info(' Enable build for %s' %vm['name'])
+            r = await self.foreman.put('/api/hosts/%d' % vm['status']['remote']['id'],{'build':True})
+            if r.status_code != 200:
+                self.log.error('Failed to enable build for %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+            else:
+                self.uf._forgetPowerOn(vm)
+                return True
+
+    @tracedPhase
+    def enableBuild(self):
+        self.log.info('Enable build for setup: %s',self.name)
+        self.uf._succeeded(self._loop(self._each,self._buildHost))
+        self.log.info('Build enabled')
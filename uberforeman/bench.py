@@ -0,0 +1,200 @@
+"""This module contains benchmark of setup lifecycle against local fake foreman
+
+Each setup size runs validate, install (which starts hosts), status and destroy against fresh
+FakeForeman running in child process, so only uberforeman itself is measured. For each phase
+wall time, foreman requests (total and per endpoint), readiness probes, connections opened, peak number of threads
+and peak of memory allocated by python are reported.
+
+Run ``python -m uberforeman.bench --help``, results saved by ``--output`` can be passed to
+``--compare`` of later run to compare versions.
+"""
+import sys, os, json, time, threading, subprocess, logging, argparse
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.x
+    tracemalloc = None
+import requests
+
+from .client import ForemanClient, PAGE_PARALLEL
+from .controller import Uberforeman
+from .defaults import PARALLEL
+
+SIZES = (10,100,1000,5000)
+PHASES = ('validate','install','status','destroy')
+
+class Measurement(object):
+    """Measures single phase, use as context manager"""
+
+    def __init__(self,fake,foreman):
+        self.fake = fake
+        self.foreman = foreman
+        self.result = {}
+
+    def _sample(self):
+        while not self.stopped.wait(0.01):
+            # do not count sampling thread
+            self.peakThreads = max(self.peakThreads,threading.active_count() - 1)
+
+    def __enter__(self):
+        self.requests = self.fake.requests()
+        self.connections = self.foreman.connectionStats()['opened']
+        self.peakThreads = threading.active_count()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+        if tracemalloc:
+            tracemalloc.start()
+        self.stdout = sys.stdout
+        # hosts being waited for print their status
+        sys.stdout = open(os.devnull,'w')
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self,excType,exc,tb):
+        self.result['wall'] = round(time.time() - self.t0,3)
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        if tracemalloc:
+            self.result['memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.stopped.set()
+        self.sampler.join()
+        self.result['threads'] = self.peakThreads
+        self.result['connections'] = self.foreman.connectionStats()['opened'] - self.connections
+        after = self.fake.requests()
+        perEndpoint = dict((key,after[key] - self.requests.get(key,0)) for key in after if after[key] != self.requests.get(key,0))
+        self.result['requests'] = sum(v for k,v in perEndpoint.items() if not k.startswith('PROBE'))
+        self.result['probes'] = sum(v for k,v in perEndpoint.items() if k.startswith('PROBE'))
+        self.result['endpoints'] = perEndpoint
+        if exc is not None:
+            self.result['error'] = str(exc)
+        return True # failed phase is reported, benchmark goes on
+
+class FakeProcess(object):
+    """FakeForeman running in child process"""
+
+    def __init__(self,args):
+        cmd = [sys.executable,'-m','uberforeman.fakeforeman',
+            '--latency',str(args.latency),'--jitter',str(args.jitter),'--error-rate',str(args.error_rate),
+            '--create-time',str(args.create_time),'--install-time',str(args.install_time),
+            '--capacity',str(args.capacity),'--power-rate',str(args.power_rate),'--lost-rate',str(args.lost_rate)]
+        if args.no_listing:
+            cmd.append('--no-listing')
+        self.process = subprocess.Popen(cmd,stdout=subprocess.PIPE,cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.url = self.process.stdout.readline().decode('utf-8').strip()
+        if not self.url:
+            raise Exception('Failed to start fake foreman, is port 49999 free?')
+        self.session = requests.Session()
+
+    def stats(self):
+        return self.session.get(self.url + '/_bench/stats').json()
+
+    def requests(self):
+        return self.stats()['requests']
+
+    def stop(self):
+        self.session.close()
+        self.process.kill()
+        self.process.wait()
+
+def benchSetup(size):
+    """Returns setup of given number of hosts"""
+    return {'hosts':[{'name':'bench','hostGroup':'Server','clones':size - 1,'params':{'role':'bench'}}]}
+
+def runSize(size,args):
+    """Runs all phases with setup of given size, returns dict of phase name to measured result"""
+    fake = FakeProcess(args)
+    results = {}
+    try:
+        foreman = ForemanClient(fake.url,'bench','bench',poolSize=args.parallel + PAGE_PARALLEL)
+        uf = Uberforeman(foreman,benchSetup(size),'bench-%d' % size,parallel=args.parallel)
+        uf.log.setLevel(logging.CRITICAL)
+        engine = uf
+        if args.engine == 'async':
+            from .aio import AsyncEngine
+            engine = AsyncEngine(uf,foremanLimit=args.parallel)
+
+        def validate():
+            uf.prefetch()
+            uf.validateSetup()
+        actions = {
+            'validate':validate,
+            'install':engine.install,
+            'status':lambda: uf.status('json'),
+            'destroy':engine.destroy}
+        for phase in PHASES:
+            with Measurement(fake,foreman) as m:
+                actions[phase]()
+            if phase == 'install':
+                stats = fake.stats()
+                m.result['installed'] = stats['installed']
+                m.result['limits'] = foreman.limiterStats()
+            results[phase] = m.result
+            if 'error' in m.result and phase == 'validate':
+                break
+    finally:
+        fake.stop()
+    return results
+
+def _memory(value):
+    return value is None and '-' or '%.1fMB' % (value / 1024.0 / 1024.0)
+
+def showText(report,baseline=None):
+    header = '%6s %-9s %9s %9s %7s %7s %8s %9s' % ('hosts','phase','wall','requests','probes','conns','threads','memory')
+    print(header)
+    print('-' * len(header))
+    for size in sorted(report['results'],key=int):
+        for phase in PHASES:
+            r = report['results'][size].get(phase)
+            if r is None:
+                continue
+            line = '%6s %-9s %8.2fs %9d %7d %7d %8d %9s' % (size,phase,r['wall'],r['requests'],r['probes'],r['connections'],r['threads'],_memory(r.get('memory')))
+            if 'installed' in r:
+                line += '  installed %d/%s' % (r['installed'],size)
+            if 'error' in r:
+                line += '  FAILED: %s' % r['error']
+            b = baseline and baseline['results'].get(size,{}).get(phase)
+            if b and b['wall']:
+                line += '  (%+.0f%% wall, %+d requests vs baseline)' % ((r['wall'] - b['wall']) / b['wall'] * 100,r['requests'] - b['requests'])
+            print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks setup lifecycle against local fake foreman')
+    parser.add_argument('--hosts', default=','.join(str(s) for s in SIZES), help='Comma separated setup sizes (default %(default)s)')
+    parser.add_argument('--parallel', type=int, default=PARALLEL, help='Max number of hosts processed in parallel (default %(default)s)')
+    parser.add_argument('--engine', choices=['thread','async'], default='thread', help='Engine driving install/destroy (default %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds each foreman request takes (default %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Max random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of foreman requests failing with 503')
+    parser.add_argument('--create-time', type=float, default=0.5, help='Seconds host creation takes (default %(default)s)')
+    parser.add_argument('--install-time', type=float, default=5.0, help='Seconds host installs after power on (default %(default)s)')
+    parser.add_argument('--no-listing', action='store_true', help='Readiness service does not provide directory listing')
+    parser.add_argument('--capacity', type=int, default=0, help='Max concurrent foreman requests, more are rejected by 503 (default unlimited)')
+    parser.add_argument('--power-rate', type=int, default=0, help='Max power on actions per second fake foreman accepts (default unlimited)')
+    parser.add_argument('--lost-rate', type=float, default=0.0, help='Fraction of foreman requests processed but answered by 504')
+    parser.add_argument('--format', choices=['text','json'], default='text', help='Output format (default %(default)s)')
+    parser.add_argument('--output', metavar='FILE', help='Save results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with results saved by --output')
+    args = parser.parse_args(argv)
+    settings = dict((k,v) for k,v in vars(args).items() if k not in ('hosts','format','output','compare'))
+    report = {'settings':settings,'python':sys.version.split()[0],'results':{}}
+    for size in [int(s) for s in args.hosts.split(',')]:
+        report['results'][str(size)] = runSize(size,args)
+        if args.format == 'text':
+            sys.stderr.write('%d hosts done\n' % size)
+    baseline = None
+    if args.compare:
+        with open(args.compare,'r') as fd:
+            baseline = json.load(fd)
+    if args.output:
+        with open(args.output,'w') as fd:
+            json.dump(report,fd,indent=2)
+    if args.format == 'json':
+        print(json.dumps(report,indent=2))
+    else:
+        showText(report,baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""This module contains persistent on-disk cache of foreman catalogs (hostgroups, domains, ...)
+
+"""
+import os, json, time, hashlib, tempfile
+from threading import Lock
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'),'.cache','uberforeman')
+
+# time to live of cached catalogs in seconds, key is resource name relative to /api/
+CACHE_TTL = {
+        'hostgroups':3600,
+        'compute_resources':3600,
+        'domains':3600,
+        'images':3600,
+        'available_clusters':3600,
+        'available_storage_domains':3600,
+        'hosts':60
+        }
+
+class CatalogCache(object):
+    """
+    Stores catalogs (lists of results) downloaded from foreman in a directory per foreman URL and user.
+    Entry of single page catalog remembers its ETag and Last-Modified header, so expired entry can be
+    revalidated by a conditional request instead of downloading whole catalog again.
+    """
+    def __init__(self,url,user,directory=CACHE_DIR,ttl=None,refresh=False):
+        """Creates new instance
+
+        :param ttl: dict of resource name to TTL in seconds overriding CACHE_TTL
+        :param refresh: when True, all entries are considered expired and are not revalidated
+        """
+        self.ttl = dict(CACHE_TTL)
+        self.ttl.update(ttl or {})
+        self.refresh = refresh
+        self.lock = Lock()
+        key = hashlib.sha1(('%s %s' % (url.rstrip('/'),user)).encode('utf-8')).hexdigest()
+        self.directory = os.path.join(directory,key)
+
+    def _ttl(self,resource):
+        # compute_resources/1/images -> images
+        return self.ttl.get(resource.split('/')[-1],self.ttl.get(resource,0))
+
+    def _path(self,resource):
+        return os.path.join(self.directory,resource.strip('/').replace('/','_') + '.json')
+
+    def load(self,resource):
+        """Returns cached entry as dict with keys results, etag, last_modified, fetched or None"""
+        if self.refresh:
+            return None
+        try:
+            with open(self._path(resource),'r') as fd:
+                return json.load(fd)
+        except (IOError,OSError,ValueError):
+            return None
+
+    def isFresh(self,resource,entry):
+        return entry is not None and time.time() - entry['fetched'] < self._ttl(resource)
+
+    def store(self,resource,results,etag=None,lastModified=None):
+        entry = {'fetched':time.time(),'etag':etag,'last_modified':lastModified,'results':results}
+        with self.lock:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory,0o700)
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd,'w') as f:
+                    json.dump(entry,f)
+                os.rename(tmp,self._path(resource))
+            except (IOError,OSError):
+                pass # cache is optional, never fail because of it
+        return entry
+
+    def touch(self,resource,entry):
+        """Marks entry as fresh after successful revalidation"""
+        return self.store(resource,entry['results'],entry['etag'],entry['last_modified'])
+
+    def invalidate(self,resource):
+        with self.lock:
+            try:
+                os.remove(self._path(resource))
+            except (IOError,OSError):
+                pass
@@ -1,63 +1,326 @@
-import requests, json
-
-def getOrFail(f):
-    def wrap(*args,**kwargs):
-        res = f(*args,**kwargs)
-        if res:
-            if len(res) == 1:
-                return res[0]
-        raise Exception('Unable to find %s by criteria %s' % (f.__name__,str(kwargs)))
-    return wrap
-
-def getOrNone(f):
-    def wrap(*args,**kwargs):
-        res = f(*args,**kwargs)
-        if res:
-            if len(res) == 1:
-                return res[0]
-    return wrap
+import requests, json, math, time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from .trace import tracer, requestName, HTTP, WAIT
+from .limiter import RequestLimiter, isOverload, retryAfter
+from .retry import RetryPolicy, failureReason, UNCERTAIN
+from .util import getOrFail, getOrNone
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+class Catalog(object):
+    """
+    List of foreman objects indexed by id, name and title. Attributes listed in ``suffixes``
+    additionally match any suffix of the value (i.e. hostgroup title 'Base/JON/Server' matches 'Server').
+    """
+    INDEXED = ('id','name','title')
+
+    def __init__(self,items,suffixes=()):
+        self.items = list(items)
+        self.suffixes = suffixes
+        self.loaded = time.time()
+        self.indexes = {}
+        for attr in self.INDEXED:
+            index = self.indexes[attr] = {}
+            for obj in self.items:
+                if attr not in obj:
+                    continue
+                value = obj[attr]
+                if attr in suffixes and isinstance(value,str):
+                    keys = set(value[i:] for i in range(len(value)))
+                else:
+                    keys = [value]
+                for key in keys:
+                    index.setdefault(key,[]).append(obj)
+
+    def _match(self,obj,arg,value):
+        if arg not in obj:
+            return False
+        if arg in self.suffixes and isinstance(obj[arg],str) and isinstance(value,str):
+            return obj[arg].endswith(value)
+        return obj[arg] == value
+
+    def find(self,**kwargs):
+        """Returns list of objects matching all given criteria"""
+        if not kwargs:
+            return list(self.items)
+        indexed = [arg for arg in kwargs.keys() if arg in self.indexes]
+        if indexed:
+            candidates = min([self.indexes[arg].get(kwargs[arg],[]) for arg in indexed],key=len)
+        else:
+            candidates = self.items
+        return [obj for obj in candidates if all(self._match(obj,arg,value) for arg,value in kwargs.items())]
+
+# default size of HTTP connection pool kept by ForemanClient
+POOL_SIZE = 50
+# page size and number of pages fetched concurrently by ForemanClient.paginate
+PER_PAGE = 250
+PAGE_PARALLEL = 4
+# number of host names resolved by single search request
+SEARCH_CHUNK = 50
+
+class ConnectionStats(object):
+    """Thread-safe counter of HTTP connections opened and reused by a session"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.opened = 0
+        self.requests = 0
+        # time first request was sent
+        self.first = None
+
+    def _opened(self):
+        with self.lock:
+            self.opened += 1
+
+    def _requested(self):
+        with self.lock:
+            self.requests += 1
+            if self.first is None:
+                self.first = time.time()
+
+    def reused(self):
+        with self.lock:
+            return max(self.requests - self.opened, 0)
+
+    def asDict(self):
+        with self.lock:
+            return {'opened':self.opened,'reused':max(self.requests - self.opened, 0),'requests':self.requests}
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report to ConnectionStats. Requests go through RequestLimiter
+    and are traced when tracing is enabled"""
+
+    def __init__(self,stats,poolSize=POOL_SIZE,limiter=None):
+        self.stats = stats
+        self.limiter = limiter or RequestLimiter()
+        super(PooledAdapter,self).__init__(pool_connections=poolSize,pool_maxsize=poolSize)
+
+    def init_poolmanager(self,*args,**kwargs):
+        super(PooledAdapter,self).init_poolmanager(*args,**kwargs)
+        stats = self.stats
+        def counting(base):
+            class CountingPool(base):
+                def _new_conn(self):
+                    stats._opened()
+                    return base._new_conn(self)
+                def _get_conn(self,*a,**kw):
+                    stats._requested()
+                    return base._get_conn(self,*a,**kw)
+            return CountingPool
+        self.poolmanager.pool_classes_by_scheme = {
+                'http':counting(HTTPConnectionPool),
+                'https':counting(HTTPSConnectionPool)
+        }
+
+    def send(self,request,**kwargs):
+        limiter = self.limiter.forRequest(request.method,urlparse(request.url).path)
+        limiter.acquire()
+        t0 = time.time()
+        r = None
+        try:
+            if not tracer.enabled:
+                r = super(PooledAdapter,self).send(request,**kwargs)
+            else:
+                with tracer.span(requestName(request.method,request.url),HTTP) as args:
+                    r = super(PooledAdapter,self).send(request,**kwargs)
+                    args['status'] = r.status_code
+            return r
+        finally:
+            # failed connection counts as overload as well
+            overloaded = r is None or isOverload(r.status_code,r.status_code == 500 and r.text or '')
+            limiter.release(time.time() - t0,overloaded,r is not None and retryAfter(r.headers) or None)
 
 class ForemanClient(object):
 
-    def __init__(self,url,user,passw):
+    def __init__(self,url,user,passw,poolSize=POOL_SIZE,cache=None,limits=None,retry=None):
+        """Creates new instance
+
+        :param poolSize: number of keep-alive connections kept to foreman, should match
+        number of hosts processed in parallel
+        :param cache: optional CatalogCache used by lookup methods
+        :param limits: optional dict of request class ('read', 'write', 'power', 'create') to max concurrency
+        :param retry: RetryPolicy of failed requests, default policy is used when not set
+        """
+        self.cache = cache
+        self.retry = retry or RetryPolicy()
+        self.lock = Lock()
+        self.catalogs = {}
+        self.catalogLocks = {}
         self.auth = (user,passw)
         self.url = url.rstrip('/')
+        self.stats = ConnectionStats()
+        # all requests (including async engine) share adaptive limits
+        self.limiter = RequestLimiter(limits)
+        # requests.Session is shared by all worker threads, urllib3 pool handles locking
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.verify = False
+        self.session.headers.update({'accept':'version=2'})
+        adapter = PooledAdapter(self.stats,poolSize,self.limiter)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
 
     def _url(self,url):
         if url.find('http') == 0:
             return url
         return self.url+'/'+url.lstrip('./')
 
-    def get(self,resource,headers={}):
-        append = '?'
-        if resource.find('?') > 0:
-            append = '&'
-        resource += append+'per_page=1000'
-        headers['accept'] = 'version=2'
-        return requests.get(self._url(resource),auth=self.auth,verify=False,headers=headers).json()
+    def connectionStats(self):
+        """Returns dict with number of connections opened and reused so far"""
+        return self.stats.asDict()
+
+    def limiterStats(self):
+        """Returns dict of request class to its current limit, requests in flight, overloads and waits"""
+        return self.limiter.asDict()
+
+    def request(self,method,resource,verify=None,**kwargs):
+        """Sends request, transient failures are retried according to RetryPolicy
+
+        :param verify: function called before non-idempotent request with unknown outcome is sent again,
+        it returns response of resource the previous attempt created or None
+        """
+        attempt = 0
+        started = time.time()
+        while True:
+            attempt += 1
+            r = error = None
+            try:
+                r = self.session.request(method,self._url(resource),**kwargs)
+                if r.status_code < 400:
+                    return r
+            except (ConnectionError,Timeout) as e:
+                error = e
+            reason = failureReason(r is not None and r.status_code or None,r is not None and r.status_code == 500 and r.text or '',error)
+            delay = self.retry.next(method,resource,attempt,started,reason,r is not None and r.status_code or None,error,verify is not None)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return r
+            with tracer.span('retry backoff',WAIT,resource=resource,attempt=attempt):
+                time.sleep(delay)
+            if verify and reason == UNCERTAIN:
+                created = verify()
+                if created is not None:
+                    self.retry.log.warning('retry method=%s resource=%s attempt=%d outcome=succeeded',method,resource,attempt)
+                    return created
+
+    def get(self,resource,headers=None,params=None):
+        return self.request('GET',resource,headers=headers,params=params).json()
+
+    def paginate(self,resource,perPage=PER_PAGE,parallel=PAGE_PARALLEL,**params):
+        """Generator yielding all results of a collection resource page by page.
+
+        First page is fetched alone to learn ``total``, remaining pages are then fetched
+        concurrently (at most ``parallel`` at once) and yielded in order.
+
+        :param params: additional query parameters (i.e. search)
+        """
+        params['per_page'] = perPage
+        params['page'] = 1
+        first = self.get(resource,params=params)
+        for item in self._pages(resource,first,params,parallel):
+            yield item
+
+    def _pages(self,resource,first,params,parallel=PAGE_PARALLEL):
+        """Yields results of already fetched first page followed by results of remaining pages"""
+        if 'results' not in first:
+            raise Exception(first.get('message',first.get('error','Unexpected response for %s' % resource)))
+        for item in first['results']:
+            yield item
+        total = first.get('subtotal',first.get('total')) or 0
+        perPage = int(first.get('per_page') or params['per_page'])
+        pages = int(math.ceil(float(total) / perPage))
+        if pages <= 1:
+            return
+
+        def fetch(page):
+            return self.get(resource,params=dict(params,page=page))['results']
+
+        executor = ThreadPoolExecutor(max_workers=max(1,min(parallel,pages - 1)))
+        futures = []
+        try:
+            futures = [executor.submit(fetch,page) for page in range(2,pages + 1)]
+            for future in futures:
+                for item in future.result():
+                    yield item
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def catalog(self,resource):
+        """Returns list of all results of collection resource (relative to /api/).
+
+        Results are served from CatalogCache while fresh, expired entries are revalidated
+        using ETag/Last-Modified of the first page and downloaded again only when changed.
+        Validators of the first page do not cover other pages, so catalogs longer than one page
+        are always downloaded again.
+        """
+        resource = resource.strip('/')
+        if self.cache is None:
+            return list(self.paginate('/api/'+resource))
+        entry = self.cache.load(resource)
+        if self.cache.isFresh(resource,entry):
+            return entry['results']
+        headers = {}
+        if entry and len(entry['results']) <= PER_PAGE:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        params = {'per_page':PER_PAGE,'page':1}
+        r = self.request('GET','/api/'+resource,headers=headers,params=params)
+        if r.status_code == 304 and headers:
+            self.cache.touch(resource,entry)
+            return entry['results']
+        first = r.json()
+        results = list(self._pages('/api/'+resource,first,params))
+        if len(results) <= int(first.get('per_page') or PER_PAGE):
+            self.cache.store(resource,results,r.headers.get('ETag'),r.headers.get('Last-Modified'))
+        else:
+            # entry without validators is downloaded again once it expires
+            self.cache.store(resource,results,None,None)
+        return results
+
+    def _modified(self,resource):
+        """Drops cached hosts catalog when request modifies hosts"""
+        resource = resource.lstrip('./')
+        if self.cache and resource.startswith('api/hosts') and not resource.endswith('/power'):
+            self.cache.invalidate('hosts')
 
     def delete(self,resource):
-        return requests.delete(self._url(resource),auth=self.auth,verify=False)
+        self._modified(resource)
+        return self.request('DELETE',resource)
 
-    def post(self,resource,data,headers={}):
+    def post(self,resource,data,headers=None,verify=None):
+        headers = dict(headers or {})
         headers['Content-type'] = 'application/json'
-        headers['accept'] = 'version=2'
-        return requests.post(self._url(resource),json.dumps(data),auth=self.auth,verify=False,headers=headers)
+        self._modified(resource)
+        return self.request('POST',resource,verify,data=json.dumps(data,default=dict),headers=headers)
     
-    def put(self,resource,data,headers={}):
+    def put(self,resource,data,headers=None):
+        headers = dict(headers or {})
         headers['Content-type'] = 'application/json'
-        headers['accept'] = 'version=2'
-        return requests.put(self._url(resource),json.dumps(data),auth=self.auth,verify=False,headers=headers)
-   
-    def task(self,uuid, **kwargs):
-        tasks = list(self.get('/api/orchestration/%s/tasks' % uuid)['results'])
-        def f(obj):
-            match = False
-            for arg,value in kwargs.items():
-                match |= obj[arg] == value
-            return match
-
-        return list(filter(f,tasks))
+        self._modified(resource)
+        return self.request('PUT',resource,data=json.dumps(data,default=dict),headers=headers)
+
+    def createHost(self,host,fqdn):
+        """Creates host, POST with unknown outcome is sent again only if host was not created meanwhile
+
+        :param host: foreman host attributes
+        :param fqdn: name foreman gives to created host
+        """
+        def created():
+            for found in self.paginate('/api/hosts',search='name ^ (%s)' % fqdn):
+                if found['name'] == fqdn:
+                    return self.request('GET','/api/hosts/%d' % found['id'])
+        return self.post('/api/hosts',{'host':host},verify=created)
 
     def power(self,host,action='state'):
         return self.put('/api/hosts/%d/power' % host,{'power_action':action})
@@ -67,90 +330,86 @@ class ForemanClient(object):
         if 'message' in test.keys():
             raise Exception(test['message'])
 
+    def _catalog(self,resource,suffixes=()):
+        """Returns indexed Catalog of given resource, loaded once per client"""
+        with self.lock:
+            if resource in self.catalogs:
+                return self.catalogs[resource]
+            # catalogs are loaded under their own lock, so different catalogs load concurrently
+            lock = self.catalogLocks.setdefault(resource,Lock())
+        with lock:
+            with self.lock:
+                if resource in self.catalogs:
+                    return self.catalogs[resource]
+            catalog = Catalog(self.catalog(resource),suffixes)
+            with self.lock:
+                self.catalogs[resource] = catalog
+            return catalog
+
+    def expireCatalogs(self,force=False):
+        """Forgets catalogs loaded longer ago than their cache TTL (all of them when force is True),
+        they are loaded again when needed. Returns list of forgotten resources"""
+        now = time.time()
+        with self.lock:
+            expired = [resource for resource,catalog in self.catalogs.items()
+                    if force or not self.cache or now - catalog.loaded >= self.cache._ttl(resource)]
+            for resource in expired:
+                del self.catalogs[resource]
+        return expired
+
+    def prefetch(self,executor):
+        """Starts loading catalogs every setup validation needs, returns list of futures
+
+        :param executor: Executor loading the catalogs
+        """
+        return [executor.submit(f) for f in (self.hostgroups,self.computeResources,self.domains)]
+
     def hostgroups(self,**kwargs):
-        if not hasattr(self,'host_groups'):
-            self.host_groups = list(self.get('/api/hostgroups')['results'])
-
-        def f(obj):
-            match = False
-            for arg,value in kwargs.items():
-                match |= 'title' == arg and obj[arg].endswith(value)
-                match |= obj[arg] == value
-            return match
-        
-        return list(filter(f, self.host_groups))
+        # hostgroup can be referred by title suffix
+        return self._catalog('hostgroups',suffixes=('title',)).find(**kwargs)
     
     def computeResources(self,**kwargs):
-        if not hasattr(self,'compute_resources'):
-            self.compute_resources = list(self.get('/api/compute_resources')['results'])
-        
-        def f(obj):
-            match = False
-            for arg,value in kwargs.items():
-                match |= obj[arg] == value
-            return match
-
-        return list(filter(f,self.compute_resources))
+        return self._catalog('compute_resources').find(**kwargs)
 
     def images(self, compute_resource, name):
-        if not hasattr(self, 'disk_images'):
-            self.disk_images  = list(self.get('api/compute_resources/%d/images' % compute_resource['id'])['results'])
-       
-        def f(obj):
-            return obj['name'] == name
+        return self._catalog('compute_resources/%d/images' % compute_resource['id']).find(name=name)
+
+    def clusters(self, compute_resource, name):
+        # foreman lists clusters (and storage domains) of compute resource using its own credentials
+        return self._catalog('compute_resources/%d/available_clusters' % compute_resource['id']).find(name=name)
 
-        return list(filter(f, self.disk_images))
+    def storages(self, compute_resource, name):
+        return self._catalog('compute_resources/%d/available_storage_domains' % compute_resource['id']).find(name=name)
 
     def domains(self,**kwargs):
-        if not hasattr(self,'_domains'):
-            self._domains = list(self.get('/api/domains')['results'])
-        
-        def f(obj):
-            match = False
-            for arg,value in kwargs.items():
-                match |= obj[arg] == value
-            return match
-        
-        return list(filter(f,self._domains))
+        return self._catalog('domains').find(**kwargs)
 
     def hosts(self,**kwargs):
-        if not hasattr(self,'_hosts'):
-            self._hosts = list(self.get('/api/hosts')['results'])
-
-        def f(obj):
-            match = False
-            for arg,value in kwargs.items():
-                match |= obj[arg] == value
-            return match
-
-        hosts = list(filter(f,self._hosts))
+        hosts = self._catalog('hosts').find(**kwargs)
         if len(hosts) == 1:
             return [self.get('/api/hosts/%d' % (hosts[0]['id']))]
 
-class OvirtClient(object):
-
-    @classmethod
-    def fromComputeResource(cls,computeResource):
-        return cls(computeResource['url'],computeResource['user'],'todo...')
+    def hostsByName(self,names,chunk=SEARCH_CHUNK,parallel=PAGE_PARALLEL):
+        """Bulk variant of hosts(name=...) resolving many host names at once.
 
-    def __init__(self,url,user,passw):
-        self.auth = (user,passw)
-        self.url = url.rstrip('/')
-    
-    def storages(self,**kwargs):
-        domains = {
-                "BC_shared":{"id":"b250d85c-2837-4efa-8c94-0f7c262418cc"},
-                "BC_perf":{"id":"05cd6fd4-de9a-4e9c-9a92-925b3e263b33"},
-            }
-        if kwargs['name'] in domains.keys():
-            return [domains[kwargs['name']]]
-    
-    def clusters(self,**kwargs):
-        clusters = {
-                "userspace":{"id":"fcb97476-3365-11e2-94d7-5254009cc188"},
-                "automation":{"id":"99408929-82cf-4dc7-a532-9d998063fa95"},
-                "performance":{"id":"93a8fc6e-3e36-11e2-8760-5254009cc188"}
-        }
-        if kwargs['name'] in clusters.keys():
-            return [clusters[kwargs['name']]]
+        Names are looked up by server-side search in chunks, details of found hosts are then
+        fetched concurrently (at most ``parallel`` at once).
 
+        :param names: list of host names (FQDN)
+        :return: dict of name to host detail, names not found in foreman are missing
+        """
+        wanted = set(names)
+        names = sorted(wanted)
+        found = []
+        for i in range(0,len(names),chunk):
+            search = 'name ^ (%s)' % ','.join(names[i:i + chunk])
+            found.extend(self.paginate('/api/hosts',search=search))
+        found = [host for host in found if host['name'] in wanted]
+        if not found:
+            return {}
+        executor = ThreadPoolExecutor(max_workers=max(1,min(parallel,len(found))))
+        try:
+            details = executor.map(lambda host: self.get('/api/hosts/%d' % host['id']),found)
+            return dict((host['name'],host) for host in details)
+        finally:
+            executor.shutdown(wait=False)
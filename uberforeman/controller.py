@@ -1,17 +1,30 @@
-import logging, re, time, copy
-from threading import Lock, Thread
-from .client import OvirtClient,getOrFail,getOrNone
-from .hostready import JonBCHostReady,ImageBasedVMHostReady
+import logging, re, copy, functools
+from threading import Lock, Event
 import json, uuid
-from .defaults import VM_DEFAULT, FOREMAN_DEFAULT
-from .util import run_parallel, run_parallel_bool
+from .defaults import VM_DEFAULT, FOREMAN_DEFAULT, PARALLEL, PREFETCH_PARALLEL, SETUP_PARAM, PAYLOAD_ATTRS
+from .host import Overlay
+from .util import run_parallel, getOrFail, chain
+from concurrent.futures import ThreadPoolExecutor, wait
+from .scheduler import DependencyScheduler, CREATED, DONE
+from .trace import tracer, tracedPhase
+from . import journal
 
 class AttrResolveException(Exception):
     pass
 
+class CancelledException(Exception):
+    pass
+
+class SetupValidationException(Exception):
+    """Raised by validateSetup, carries list of (host name, exception) tuples"""
+
+    def __init__(self,errors):
+        self.errors = errors
+        Exception.__init__(self,'Setup validation failed for %d host(s): %s' % (len(errors),', '.join(name for name,e in errors)))
+
 class Uberforeman(object):
 
-    def __init__(self,foreman,setup,name,hostDefaults={}):
+    def __init__(self,foreman,setup,name,hostDefaults={},parallel=PARALLEL,journal=None,identity=None):
         self.log = logging.getLogger("Foreman")
         self.log.setLevel(logging.INFO)
         if len(self.log.handlers) == 0:
@@ -21,9 +34,35 @@ class Uberforeman(object):
             ch.setFormatter(formatter)
             self.log.addHandler(ch)
         self.foreman = foreman
-        self.vmChecker = JonBCHostReady(foreman)
+        self.vmChecker = self.taskTracker = None
+        if foreman is not None:
+            # foreman is None when setup is only loaded (--dump), requests are then not even imported
+            from .hostready import JonBCHostReady,TaskTracker
+            self.vmChecker = JonBCHostReady(foreman)
+            self.taskTracker = TaskTracker(foreman)
+            self.taskTracker.addListener(self._taskProgress)
         self.setup = setup
         self.name = name
+        # unique identity of setup hosts are tagged with, plan deletes tagged hosts which are no longer part
+        # of setup. Explicit 'id' of setup wins over given identity (see journal.setupKey), which changes with
+        # location of setup file. Without identity hosts are not tagged and never deleted by plan
+        self.identity = setup.get('id',identity)
+        self.parallel = parallel
+        self.memo = {}
+        self.memoLock = Lock()
+        # guards state of hosts modified by worker threads
+        self.lock = Lock()
+        # optional Journal of host transitions, trusted by install only when resume is True
+        self.journal = journal
+        self.resume = False
+        # optional semaphore shared by setups of --batch, bounds number of hosts processed at once by all of them
+        self.slots = None
+        # names of hosts which failed since setup was validated
+        self.failed = []
+        # set by cancel(), host tasks are not started anymore and waits for hosts end
+        self.cancelled = Event()
+        # hosts found in foreman by prefetch(), used by next validateSetup
+        self.remotes = None
         if hostDefaults is None:
                 hostDefaults = {}
         self._applyDefaults(hostDefaults)
@@ -60,53 +99,225 @@ class Uberforeman(object):
         default.update(hostDefaults)
         default.update(self.setup['default-host'])
         self.setup['default-host'] = default
-        vms = []
+        # hosts share defaults, only their own attributes are kept per host
+        self.setup['hosts'] = [Overlay(default,vm) for vm in self.setup['hosts']]
+
+    def _lookup(self,key,f,**kwargs):
+        """Memoized getOrFail(f)(**kwargs), key identifies the lookup function"""
+        key = (key,tuple(sorted((k,v['id'] if isinstance(v,dict) else v) for k,v in kwargs.items())))
+        with self.memoLock:
+            if key in self.memo:
+                return self.memo[key]
+        value = getOrFail(f)(**kwargs)
+        with self.memoLock:
+            return self.memo.setdefault(key,value)
+
+    def _validateHost(self,vm,remotes):
+        f = self.foreman
+        self.log.info(' Validating %s', vm['name'])
+        vm['status'] = {}
+        remote = vm['status']['remote'] = remotes.get('%s.%s' % (vm['name'],vm['domain']))
+        if remote:
+            # copy IP directly to VM so we can access it easily
+            vm['ip'] = remote['ip']
+        # foreman payload is shared by all hosts with same definition (i.e. clones)
+        local = vm['status']['local'] = Overlay(self._payload(vm))
+        local['name'] = vm['name']
+        local['progress_report_id'] = str(uuid.uuid4()) # generate UUID to track task
+
+    def _payload(self,vm):
+        """Returns foreman payload for given host definition, name and params are filled per host"""
+        key = ('payload',) + tuple(vm[k] for k in PAYLOAD_ATTRS)
+        with self.memoLock:
+            if key in self.memo:
+                return self.memo[key]
+        f = self.foreman
+        local = copy.deepcopy(FOREMAN_DEFAULT)
+        hostgroup = self._lookup('hostgroups',f.hostgroups,title=vm['hostGroup'])
+        local['hostgroup_id'] = hostgroup['id']
+        local['subnet_id'] = hostgroup['subnet_id']
+        cr = self._lookup('computeResources',f.computeResources,name=vm['computeResource'])
+        assert cr['provider'] == 'oVirt', "Invalid computeResource=%s detected, only 'oVirt' is supported" % cr['provider']
+        local['compute_resource_id'] = cr['id']
+        if vm['image'] and len(vm['image']) > 0:
+            image = self._lookup('images',f.images,compute_resource=cr,name=vm['image'])
+            local['image_id'] = image['id']
+            local['provision_method'] = 'image'
+            local['operatingsystem_id'] = image['operatingsystem_id'] # take op sys from image
+            local['compute_attributes']['start'] = '1' # start immediatelly to finish orchestration task
+            local['compute_attributes']['image_id'] = image['uuid'] # pass oVirt image UUID to compute_attributes
+        local['domain_id'] = self._lookup('domains',f.domains,name=vm['domain'])['id']
+        local['compute_attributes']['cluster'] = self._lookup('clusters',f.clusters,compute_resource=cr,name=vm['cluster'])['id']
+        local['compute_attributes']['volumes_attributes']['0']['storage_domain'] = self._lookup('storages',f.storages,compute_resource=cr,name=vm['storage'])['id']
+        local['compute_attributes']['volumes_attributes']['0']['size_gb'] = vm['disk']
+        local['compute_attributes']['memory'] = int(vm['ram'] * 1024 * 1024 * 1024)
+        local['compute_attributes']['cores'] = int(vm['cpus'])
+        with self.memoLock:
+            return self.memo.setdefault(key,local)
+
+    def _slotted(self,target):
+        """Wraps target so each call holds one of shared slots (if there are any) and fails once
+        command was cancelled"""
+        @functools.wraps(target)
+        def wrapper(*args):
+            if self.cancelled.is_set():
+                raise CancelledException('cancelled')
+            if self.slots is None:
+                return target(*args)
+            with self.slots:
+                return target(*args)
+        return wrapper
+
+    def cancel(self):
+        """Cancels running command, hosts being processed finish their current request"""
+        self.cancelled.set()
+
+    def _run(self,target,hosts,*args):
+        """Runs target(vm,*args) for all hosts on bounded thread pool, returns list of TaskResult"""
+        return run_parallel(tracer.hostStep(self._slotted(target)),[(vm,) + args for vm in hosts],self.parallel)
+
+    def _succeeded(self,results):
+        """Logs failures of tasks, returns True when all tasks succeeded"""
+        for r in results:
+            if r.exception:
+                self.log.error('%s failed after %ds : %s',r.args[0]['name'],r.duration,r.exception)
+        with self.lock:
+            self.failed.extend(r.args[0]['name'] for r in results if not r.ok)
+        return all(r.ok for r in results)
+
+    def _references(self,vm):
+        """Returns names of hosts referred by $host: expressions in params of given host"""
+        names = []
+        for value in vm['params'].values():
+            expr = isinstance(value,str) and self._expr(value)
+            if expr and expr[0] == 'host':
+                names.append(expr[1])
+        return names
+
+    def _scheduler(self,target,references=False):
+        """Creates DependencyScheduler running target for each host.
+
+        Host depends on all hosts of lower order (hosts of each phase are joined by a barrier node)
+        unless it lists its prerequisites in 'after' attribute. With references, host also depends on
+        creation of hosts it refers to by $host: expressions.
+        """
+        scheduler = DependencyScheduler(self.parallel)
+        previous = None
+        for phase in sorted(set(vm['order'] for vm in self.setup['hosts'])):
+            hosts = [vm for vm in self.setup['hosts'] if vm['order'] == phase]
+            for vm in hosts:
+                if 'after' in vm:
+                    deps = [(name,DONE) for name in vm['after']]
+                else:
+                    deps = previous and [(previous,DONE)] or []
+                if references:
+                    deps += [(name,CREATED) for name in self._references(vm)]
+                scheduler.add(vm['name'],tracer.hostStep(self._slotted(target)),(vm,),deps)
+            barrier = '<phase %d>' % phase
+            scheduler.add(barrier,deps=[(vm['name'],DONE) for vm in hosts] + (previous and [(previous,DONE)] or []))
+            previous = barrier
+        return scheduler
+
+    def _runScheduler(self,scheduler):
+        """Runs scheduler, returns list of TaskResult of hosts"""
+        results = scheduler.run()
+        return [results[vm['name']] for vm in self.setup['hosts']]
+
+    def _record(self,vm,transition):
+        if self.journal:
+            self.journal.record(vm['name'],transition,id=vm['status']['remote']['id'])
+
+    def _forgetPowerOn(self,vm):
+        """Forgets journaled power on and install of host which is down (or about to be reinstalled)"""
+        if self.journal:
+            self.journal.forget(vm['name'],journal.POWERED_ON,journal.INSTALLED)
+
+    def _journaled(self,vm,transition):
+        """Returns True when resuming and journal says host already went through transition"""
+        return self.resume and self.journal is not None and self.journal.has(vm['name'],transition)
+
+    def _checkJournal(self):
+        """Forgets journal entries of hosts which were deleted or recreated meanwhile"""
+        for vm in self.setup['hosts']:
+            entry = self.journal.get(vm['name'])
+            remote = vm['status']['remote']
+            if entry and (remote is None or remote['id'] != entry.get('id')):
+                self.log.info(' Journal of %s is outdated, ignoring it', vm['name'])
+                self.journal.forget(vm['name'])
+
+    def references(self):
+        """Returns dict of resources referenced by setup: hostgroups, domains, computeResources (names),
+        images, clusters and storages (sets of (compute resource, name)) and hosts (FQDNs)"""
+        refs = dict((key,set()) for key in ('hostgroups','domains','computeResources','images','clusters','storages','hosts'))
         for vm in self.setup['hosts']:
-            host = copy.deepcopy(default)
-            host.update(vm)
-            vms.append(host)
-        self.setup['hosts'] = vms
+            refs['hostgroups'].add(vm['hostGroup'])
+            refs['domains'].add(vm['domain'])
+            refs['computeResources'].add(vm['computeResource'])
+            if vm['image']:
+                refs['images'].add((vm['computeResource'],vm['image']))
+            refs['clusters'].add((vm['computeResource'],vm['cluster']))
+            refs['storages'].add((vm['computeResource'],vm['storage']))
+            refs['hosts'].add('%s.%s' % (vm['name'],vm['domain']))
+        return refs
 
+    @tracedPhase
+    def prefetch(self):
+        """Fetches everything setup refers to concurrently (foreman catalogs, images, clusters and storage domains
+        of each compute resource used, hosts), so validateSetup finds lookups memoized. Lookups which fail
+        are left to validateSetup, which reports them per host"""
+        f = self.foreman
+        refs = self.references()
+        executor = ThreadPoolExecutor(max_workers=PREFETCH_PARALLEL)
+        try:
+            hosts = executor.submit(f.hostsByName,sorted(refs['hosts']))
+            futures = [executor.submit(self._lookup,'hostgroups',f.hostgroups,title=title) for title in refs['hostgroups']]
+            futures += [executor.submit(self._lookup,'domains',f.domains,name=name) for name in refs['domains']]
+            crs = dict((name,executor.submit(self._lookup,'computeResources',f.computeResources,name=name)) for name in refs['computeResources'])
+            # images, clusters and storage domains are per compute resource, they are fetched once it is known
+            for name,future in crs.items():
+                try:
+                    cr = future.result()
+                except Exception:
+                    continue
+                futures += [executor.submit(self._lookup,'images',f.images,compute_resource=cr,name=image) for c,image in refs['images'] if c == name]
+                futures += [executor.submit(self._lookup,'clusters',f.clusters,compute_resource=cr,name=cluster) for c,cluster in refs['clusters'] if c == name]
+                futures += [executor.submit(self._lookup,'storages',f.storages,compute_resource=cr,name=storage) for c,storage in refs['storages'] if c == name]
+            wait(futures)
+            try:
+                self.remotes = hosts.result()
+            except Exception:
+                self.remotes = None
+        finally:
+            executor.shutdown(wait=False)
+
+    @tracedPhase
     def validateSetup(self):
-        """Validates setup by checking state/existence of hosts and referenced resources"""
+        """Validates setup by checking state/existence of hosts and referenced resources
+
+        Hosts are validated in parallel, errors of all hosts are reported together
+        by raising SetupValidationException
+        """
         self.log.info('Validating setup ... please wait')
-        f = self.foreman
-        for vm in self.setup['hosts']:
-            self.log.info(' Validating %s', vm['name'])
-            vm['status'] = {}
-            remote = vm['status']['remote'] = getOrNone(self.foreman.hosts)(name='%s.%s' % (vm['name'],vm['domain']))
-            if remote:
-                # copy IP directly to VM so we can access it easily
-                vm['ip'] = remote['ip']
-            local = vm['status']['local'] = copy.deepcopy(FOREMAN_DEFAULT)
-            local['name'] = vm['name']
-            hostgroup = getOrFail(f.hostgroups)(title=vm['hostGroup'])
-            local['hostgroup_id'] = hostgroup['id']
-            local['subnet_id'] = hostgroup['subnet_id']
-            cr = getOrFail(f.computeResources)(name=vm['computeResource'])
-            assert cr['provider'] == 'oVirt', "Invalid computeResource=%s detected, only 'oVirt' is supported" % cr['provider']
-            local['compute_resource_id'] = cr['id']
-            if vm['image'] and len(vm['image']) > 0:
-                image = getOrFail(self.foreman.images)(compute_resource=cr,name=vm['image'])
-                local['image_id'] = image['id']
-                local['provision_method'] = 'image'
-                local['operatingsystem_id'] = image['operatingsystem_id'] # take op sys from image
-                local['compute_attributes']['start'] = '1' # start immediatelly to finish orchestration task
-                local['compute_attributes']['image_id'] = image['uuid'] # pass oVirt image UUID to compute_attributes
-            local['progress_report_id'] = str(uuid.uuid4()) # generate UUID to track task
-            cr = OvirtClient.fromComputeResource(cr)
-            local['domain_id'] = getOrFail(f.domains)(name=vm['domain'])['id']
-            local['compute_attributes']['cluster'] = getOrFail(cr.clusters)(name=vm['cluster'])['id']
-            local['compute_attributes']['volumes_attributes']['0']['storage_domain'] = getOrFail(cr.storages)(name=vm['storage'])['id']
-            local['compute_attributes']['volumes_attributes']['0']['size_gb'] = vm['disk']
-            local['compute_attributes']['memory'] = int(vm['ram'] * 1024 * 1024 * 1024)
-            local['compute_attributes']['cores'] = int(vm['cpus'])
+        self.failed = []
+        remotes, self.remotes = self.remotes, None
+        if remotes is None:
+            remotes = self.foreman.hostsByName(['%s.%s' % (vm['name'],vm['domain']) for vm in self.setup['hosts']])
 
+        results = self._run(self._validateHost,self.setup['hosts'],remotes)
+        errors = [(r.args[0]['name'],r.exception) for r in results if r.exception]
+        if errors:
+            for name,e in errors:
+                self.log.error(' %s : %s',name,e)
+            raise SetupValidationException(errors)
+        if self.journal:
+            self._checkJournal()
 
     def _validateSetup(self):
         """Validates setup file format - it's just a syntactic check of correct keys/values"""
         s = self.setup
         assert 'hosts' in s.keys(), "hosts array is required"
+        if 'id' in s:
+            assert isinstance(s['id'],str) and len(s['id']) > 0, "id attribute must be non-empty string"
     
         def _typeNumAttrs(host):
             for attr in ['order','clones','cpus','ram']:
@@ -146,88 +357,159 @@ class Uberforeman(object):
                 vm['params'] = {}
             assert type(vm['params']) == type({}), "params attribute must be dict"
 
-        # expand clones
-        for host in s['hosts']:
-            for c in range(host['clones']):
-                clone = copy.deepcopy(host)
-                clone['name'] += str(c+1)
-                clone['clones'] = 0
-                s['hosts'].append(clone)
+        # expand clones, host and its clones are thin overlays of the same template
+        hosts = []
+        for template in s['hosts']:
+            if template['clones'] == 0:
+                hosts.append(template)
+                continue
+            hosts.append(template.derive())
+            for c in range(template['clones']):
+                hosts.append(template.derive({'name':template['name'] + str(c+1),'clones':0}))
+        s['hosts'] = hosts
 
         s['hosts'] = sorted(s['hosts'],key=lambda x: x['order'])
-        assert len(set(map(lambda x: x['name'],s['hosts']))) == len(s['hosts']), "name attr of VM in setup must me unique"
+        names = set(map(lambda x: x['name'],s['hosts']))
+        assert len(names) == len(s['hosts']), "name attr of VM in setup must me unique"
+        for vm in s['hosts']:
+            if 'after' in vm:
+                assert type(vm['after']) == list, "after attribute must be list of host names"
+                for name in vm['after']:
+                    assert name in names, "host %s is after unknown host %s" % (vm['name'],name)
+            for name in self._references(vm):
+                assert name in names, "host %s refers to unknown host %s" % (vm['name'],name)
         
-    def _showOutOfSyncWarnings(self,vm):
+    def _outOfSync(self,vm):
+        """Compares local and remote state of existing host, returns dict with remote hostgroup label
+        (None when in sync) and params changed, missing or added on server"""
         local = vm['status']['local']
         remote = vm['status']['remote']
+        result = {'hostgroup':None,'params':{'changed':{},'missing':{},'added':{}}}
         # detect hostgroup change
         if local['hostgroup_id'] != remote['hostgroup_id']:
-            remoteHG = self.foreman.hostgroups(id=remote['hostgroup_id'])[0]['label']                
-            self.log.warn('HostGroup is out of sync, consider --force-install, foreman reports : %s',remoteHG)
+            result['hostgroup'] = self._lookup('hostgroups',self.foreman.hostgroups,id=remote['hostgroup_id'])['label']
         # detect param additions/removals and value changes
-        remote_params = []
-        if 'parameters' in remote.keys():
-            remote_params =  map(lambda p:{p['name']:p['value']},remote['parameters'])
         rp = {}
-        [rp.update(x) for x in remote_params]
+        for p in remote.get('parameters',[]):
+            if p['name'] != SETUP_PARAM:
+                rp[p['name']] = p['value']
         lp = {}
-        diff = {}
         for key,value in vm['params'].items():
-            lp[key] = self._resolveExpr(value)
-        if hasattr(lp,'viewitems'): # python 2.6
-            diff = dict(lp.viewitems() ^ rp.viewitems())
-        else: # python 3.x
-            diff = dict(lp.items() ^ rp.items())
-        if len(diff) > 0:
+            try:
+                lp[key] = self._resolveExpr(value)
+            except AttrResolveException:
+                lp[key] = value
+        params = result['params']
+        for key in set(lp.keys()) | set(rp.keys()):
+            if key in lp and key in rp:
+                if lp[key] != rp[key]:
+                    params['changed'][key] = rp[key]
+            elif key in lp:
+                params['missing'][key] = lp[key]
+            else:
+                params['added'][key] = rp[key]
+        return result
+
+    def _showOutOfSyncWarnings(self,outOfSync):
+        if outOfSync['hostgroup']:
+            self.log.warn('HostGroup is out of sync, consider --force-install, foreman reports : %s',outOfSync['hostgroup'])
+        params = outOfSync['params']
+        if params['changed'] or params['missing'] or params['added']:
             self.log.warn('Parameter values are out of sync, consider --force-install, server values:')
-            for key,value in diff.items():
-                if key in lp and key in rp:
-                    self.log.warn(' changed : %s=%s', key, value)
-                elif key in lp:
-                    self.log.warn(' missing : %s=%s', key, value)
-                elif key in rp:
-                    self.log.warn(' added   : %s=%s', key, value)
+            for label,kind in [('changed','changed'),('missing','missing'),('added  ','added')]:
+                for key,value in sorted(params[kind].items()):
+                    self.log.warn(' %s : %s=%s', label, key, value)
+
     def dump(self):
         for vm in self.setup['hosts']:
-            del vm['status']
-        print(json.dumps(self.setup,indent=2))
+            vm.pop('status',None)
+        print(json.dumps(self.setup,indent=2,default=dict))
+
+    def _hostFacts(self,vm):
+        """Collects status of single host"""
+        remote = vm['status']['remote']
+        facts = {
+            'name':vm['name'],
+            'order':vm['order'],
+            'hostGroup':self._lookup('hostgroups',self.foreman.hostgroups,id=vm['status']['local']['hostgroup_id'])['title'],
+            'exists':remote != None
+        }
+        if remote:
+            facts['hostname'] = '%s.%s' % (vm['name'],vm['domain'])
+            facts['ip'] = vm['ip']
+            facts['building'] = remote['build']
+            facts['state'] = self.vmChecker.getStatus(vm['ip'])
+            facts['power'] = self.foreman.power(remote['id'],'state').json()['power']
+            if remote['provision_method'] == 'image':
+                facts['image'] = remote['image_name']
+            facts['outOfSync'] = self._outOfSync(vm)
+        return facts
 
-    def status(self):
+    def facts(self):
+        """Returns list of facts about all hosts, facts are collected in parallel"""
+        results = self._run(self._hostFacts,self.setup['hosts'])
+        for r in results:
+            if r.exception:
+                raise r.exception
+        return [r.result for r in results]
+
+    @tracedPhase
+    def status(self,format='text'):
+        """Shows status of all hosts
+
+        :param format: 'text' logs human readable status, 'json' prints JSON document
+        """
+        hosts = self.facts()
+        if format == 'json':
+            print(json.dumps({'setup':self.name,'hosts':hosts},indent=2))
+            return
         sep = '-------------------------------------------'
         self.log.info("Status for setup : %s", self.name)
         self.log.info(sep)
-        for vm in self.setup['hosts']:
-            exists = vm['status']['remote'] != None
-            power = 'unknown'
-            if exists:
-                power = self.foreman.power(vm['status']['remote']['id'],'state').json()['power']
-            self.log.info(' VM name     : %s',vm['name'])
-            self.log.info(' Order/phase : %d',vm['order'])
-            self.log.info(' HostGroup   : %s',self.foreman.hostgroups(title=vm['hostGroup'])[0]['title'])
-            if exists:
-                self.log.info(' Hostname    : %s.%s',vm['name'],vm['domain'])
-                self.log.info(' IP          : %s',vm['ip'])
-                self.log.info(' Building    : %r',vm['status']['remote']['build'])
-                self.log.info(' State       : %s', self.vmChecker.getStatus(vm['ip']))
-                self.log.info(' Power       : %s', power)
-                if vm['status']['remote']['provision_method'] == 'image':
-                    self.log.info(' Image       : %s'% vm['status']['remote']['image_name'])
-                self._showOutOfSyncWarnings(vm)
+        for facts in hosts:
+            self.log.info(' VM name     : %s',facts['name'])
+            self.log.info(' Order/phase : %d',facts['order'])
+            self.log.info(' HostGroup   : %s',facts['hostGroup'])
+            if facts['exists']:
+                self.log.info(' Hostname    : %s',facts['hostname'])
+                self.log.info(' IP          : %s',facts['ip'])
+                self.log.info(' Building    : %r',facts['building'])
+                self.log.info(' State       : %s',facts['state'])
+                self.log.info(' Power       : %s',facts['power'])
+                if 'image' in facts:
+                    self.log.info(' Image       : %s',facts['image'])
+                self._showOutOfSyncWarnings(facts['outOfSync'])
             else:
                 self.log.info(' VM does not exist in foreman, run --install')
             self.log.info(sep)
 
+    def _hostParameters(self,vm):
+        """Resolves params of host and puts them to its foreman payload"""
+        # payload is shared among hosts, replace params instead of modifying them
+        params = {}
+        index = 0
+        for key,value in vm['params'].items():
+            value = self._resolveExpr(value)
+            params[str(index)] = {'name':key,'value':value,'reference_id':0,'nested':''}
+            index+=1
+        if self.identity:
+            # tag host, so plan can find hosts removed from setup
+            params[str(index)] = {'name':SETUP_PARAM,'value':self.identity,'reference_id':0,'nested':''}
+        vm['status']['local']['host_parameters_attributes'] = params
+
+    def _taskProgress(self,event):
+        if event['status'] == 'running':
+            self.log.info('%s : %s (%d/%d tasks done)',event['host'],event['task'] or 'pending',event['done'],event['total'])
+        elif event['status'] == 'failed':
+            self.log.error('%s : orchestration failed (%d/%d tasks done)',event['host'],event['done'],event['total'])
+
+    @tracedPhase
     def install(self):
         self.log.info("Installing setup : %s" % self.name)
         if len(self.setup['hosts']) == 0:
             self.log.info('Empty setup?')
             return
         
-        def trackTask(uuid):
-            time.sleep(10)
-            hr = ImageBasedVMHostReady(self.foreman,uuid)
-            hr.waitForInstalled(None,None)
-
         def installHost(vm):
             with lock:
                 exists = vm['status']['remote'] != None
@@ -235,28 +517,17 @@ class Uberforeman(object):
                 self.log.info('host %s already exists', vm['name'])
                 return True
             else:
-                index = 0
-                for key,value in vm['params'].items():
-                    resolved = False
-                    while resolved == False:
-                        try:
-                            with lock:
-                                value = self._resolveExpr(value)
-                                resolved = True
-                        except AttrResolveException:
-                            # refering to host attr which is not yet ready .. waiting 
-                            time.sleep(1)
-                            #self.log.info('sleeping because waiting for %s' % value)
-
-                    param = {'name':key,'value':value,'reference_id':0,'nested':''}
-                    vm['status']['local']['host_parameters_attributes'][str(index)] = param
-                    index+=1
-
+                # referenced hosts are already created, scheduler takes care of it
+                with lock:
+                    self._hostParameters(vm)
                 self.log.info('Installing %s ..', vm['name'])
-                thread = Thread(target = trackTask, args = (vm['status']['local']['progress_report_id'], ))
-                thread.daemon = True
-                thread.start()
-                r = self.foreman.post('/api/hosts',{'host':vm['status']['local']})
+                # foreman returns once orchestration tasks are done, track their progress meanwhile
+                uuid = vm['status']['local']['progress_report_id']
+                self.taskTracker.track(uuid,vm['name'])
+                try:
+                    r = self.foreman.createHost(vm['status']['local'],'%s.%s' % (vm['name'],vm['domain']))
+                finally:
+                    self.taskTracker.untrack(uuid)
                 if r.status_code != 200:
                     self.log.error('server returned %d : %s',r.status_code,r.text)
                     raise Exception('failed to install host')
@@ -264,30 +535,22 @@ class Uberforeman(object):
                 with lock:
                     vm['status']['remote'] = r.json()
                     vm['ip'] = vm['status']['remote']['ip']
-                    if thread.isAlive():
-                        thread.join()
+                self._record(vm,journal.CREATED)
+                scheduler.mark(vm['name'],CREATED)
                 if vm['status']['local']['provision_method'] == 'image':
                     self.log.info('Waiting for %s (image-based) to get installed...', vm['name'])
-                    self.vmChecker.waitForInstalled(vm['ip'],vm['name'])
-                    self.log.info('Host %s is installed' %vm['name'])
+                    return self._whenInstalled(vm)
                 return True
 
         lock = Lock()
-        phase = self.setup['hosts'][0]['order']
-        to_install = len(self.setup['hosts'])
-        success = True
-        while to_install > 0:
-            hosts = list(filter(lambda x:x['order'] == phase,self.setup['hosts']))
-            to_install -= len(hosts)
-            self.log.info('Installing phase %d',phase)
-            phase += 1
-            success &= run_parallel_bool(installHost, map(lambda x: (x,), hosts))
-            if not success:
-                self.log.error('Failed to start/install several hosts')
-                return
-        if success:
+        if self.journal and not self.resume:
+            self.journal.clear()
+        scheduler = self._scheduler(installHost,references=True)
+        if self._succeeded(self._runScheduler(scheduler)):
             self.log.info('Setup deployed to foreman')
             self.start()
+        else:
+            self.log.error('Failed to start/install several hosts')
 
 
     def _stopHost(self,vm):    
@@ -298,91 +561,90 @@ class Uberforeman(object):
                 self.log.error('Failed to stop %s, server returned %d : %s',vm['name'],r.status_code,r.text)
             else:
                 self.log.info('VM %s was stopped', vm['name'])
+                self._forgetPowerOn(vm)
+                return True
         else:
             self.log.warn('VM %s does not exist in foreman',vm['name'])
+            # nothing to stop
+            return True
 
+    @tracedPhase
     def stop(self):
         self.log.info("Power off setup : %s" % self.name)
-        run_parallel(self._stopHost, map(lambda x: (x,), self.setup['hosts']))
+        self._succeeded(self._run(self._stopHost,self.setup['hosts']))
         self.log.info('Setup powered off')
     
+    def _destroyHost(self,vm):
+        if vm['status']['remote']:
+            self.log.info(' Destroying %s' %vm['name'])
+            r = self.foreman.delete('/api/hosts/%d' % vm['status']['remote']['id'])
+            # 404 means retried DELETE found host already deleted by lost attempt
+            if r.status_code not in (200,404):
+                self.log.error('Failed to destroy %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+                return
+            with self.lock:
+                vm['status']['remote'] = None
+                del vm['ip']
+            if self.journal:
+                self.journal.forget(vm['name'])
+            return True
+        else:
+            self.log.warn('Host %s does not exist in foreman',vm['name'])
+            # nothing to destroy
+            return True
+
+    @tracedPhase
     def destroy(self):
         self.log.info('Destroy setup: %s',self.name)
-        def destroyHost(vm):
-            if vm['status']['remote']:
-                self.log.info(' Destroying %s' %vm['name'])
-                r = self.foreman.delete('/api/hosts/%d' % vm['status']['remote']['id'])
-                if r.status_code != 200:
-                    self.log.error('Failed to destroy %s, server returned %d : %s',vm['name'],r.status_code,r.text)
-                with lock:
-                    vm['status']['remote'] = None
-                    del vm['ip']
-            else:
-                self.log.warn('Host %s does not exist in foreman',vm['name'])
-        
-        lock = Lock()
-        run_parallel(destroyHost, map(lambda x: (x,), self.setup['hosts']))
+        self._succeeded(self._run(self._destroyHost,self.setup['hosts']))
         self.log.info('Setup destroyed')
         
+    def _whenInstalled(self,vm):
+        """Returns Future of host getting installed, scheduler releases worker of host meanwhile"""
+        def installed(status):
+            self.log.info('Host %s is installed' %vm['name'])
+            self._record(vm,journal.INSTALLED)
+            return True
+        return chain(self.vmChecker.whenInstalled(vm['ip'],vm['name'],self.cancelled),installed)
+
     def _startHost(self,vm):
         exists = vm['status']['remote'] != None
         if not exists:
             raise Exception('VM %s does not exist in foreman, use --install' % vm['name'])
+        # power state is cheap to check and tells whether journal is still true (host may be stopped meanwhile)
         power = self.foreman.power(vm['status']['remote']['id'],'state').json()['power']
+        if power != 'up':
+            self._forgetPowerOn(vm)
+        elif self._journaled(vm,journal.INSTALLED):
+            self.log.info('host %s is already installed (journal)', vm['name'])
+            return True
         installed = self.vmChecker.isInstalled(vm['ip'])
         if power == 'up' and installed:
             self.log.info('host %s is already installed', vm['name'])
+            self._record(vm,journal.INSTALLED)
             return True
         elif power == 'up':
             self.log.info('Waiting for %s to get installed...', vm['name'])
-            self.vmChecker.waitForInstalled(vm['ip'],vm['name'])
-            self.log.info('Host %s is installed' %vm['name'])
-            return True
+            return self._whenInstalled(vm)
         self.log.info('Power on %s' %vm['name'])
+        # foreman asking to try again later is handled by retry policy of ForemanClient
         r = self.foreman.power(vm['status']['remote']['id'],'start')
-
-        def needs_wait(r):
-            """return true if message returned by foreman indicates that we just need to wait to get power on
-            action succeed"""
-            if r.status_code != 500:
-                return False
-            try:
-                msg = r.json()
-                if 'error' in msg.keys() and 'message' in msg['error'].keys():
-                    if msg['error']['message'].find('Please try again in a few minutes') > 0:
-                        self.log.warning('Host failed to start : %s',msg['error']['message'])
-                        self.log.info('Obeying, waiting and retrying...')
-                        return True
-            except: # just in case foreman does not return JSON
-                pass
-
-        while needs_wait(r):
-            time.sleep(5)
-            r = self.foreman.power(vm['status']['remote']['id'],'start')
         if r.status_code != 200:
             self.log.error('Failed to start %s, server returned %d : %s',vm['name'],r.status_code,r.text)
         else:
+            self._record(vm,journal.POWERED_ON)
             self.log.info('Waiting for %s to get installed...', vm['name'])
-            self.vmChecker.waitForInstalled(vm['ip'],vm['name'])
-            self.log.info('Host %s is installed' %vm['name'])
-            return True
+            return self._whenInstalled(vm)
 
+    @tracedPhase
     def start(self):
         self.log.info("Starting setup : %s" % self.name)
         if len(self.setup['hosts']) == 0:
             self.log.info('Empty setup?')
             return
-        phase = self.setup['hosts'][0]['order']
-        to_start = len(self.setup['hosts'])
-        while to_start > 0:
-            hosts = list(filter(lambda x:x['order'] == phase,self.setup['hosts']))
-            to_start -= len(hosts)
-            self.log.info('Starting phase %d',phase)
-            phase += 1
-            success = run_parallel_bool(self._startHost, map(lambda x: (x,), hosts))
-            if not success:
-                self.log.error('Failed to start/install several hosts')
-                return
+        if not self._succeeded(self._runScheduler(self._scheduler(self._startHost))):
+            self.log.error('Failed to start/install several hosts')
+            return
 
         self.log.info('Setup started')
     
@@ -392,11 +654,142 @@ class Uberforeman(object):
             r = self.foreman.put('/api/hosts/%d' % vm['status']['remote']['id'],{'build':True})
             if r.status_code != 200:
                 self.log.error('Failed to enable build for %s, server returned %d : %s',vm['name'],r.status_code,r.text)
+            else:
+                self._forgetPowerOn(vm)
+                return True
     
+    @tracedPhase
     def enableBuild(self):
         self.log.info('Enable build for setup: %s',self.name)
-        run_parallel(self._buildHost, map(lambda x: (x,), self.setup['hosts']))
+        self._succeeded(self._run(self._buildHost,self.setup['hosts']))
         self.log.info('Build enabled')
 
+    def _provisioningChanged(self,vm):
+        local = vm['status']['local']
+        remote = vm['status']['remote']
+        if local['provision_method'] != remote.get('provision_method',local['provision_method']):
+            return True
+        return local['provision_method'] == 'image' and local['image_id'] != remote.get('image_id',local['image_id'])
+
+    @tracedPhase
+    def plan(self):
+        """Compares setup with foreman and returns list of actions needed to converge it. Action is a dict
+        with keys action ('create', 'update', 'rebuild' or 'delete'), host and reason"""
+        def hostPlan(vm):
+            if vm['status']['remote'] == None:
+                return {'action':'create','host':vm['name'],'reason':'does not exist in foreman'}
+            outOfSync = self._outOfSync(vm)
+            if outOfSync['hostgroup']:
+                return {'action':'rebuild','host':vm['name'],'reason':'hostgroup changed, foreman reports %s' % outOfSync['hostgroup']}
+            if self._provisioningChanged(vm):
+                return {'action':'rebuild','host':vm['name'],'reason':'provisioning method or image changed'}
+            params = outOfSync['params']
+            if params['changed'] or params['missing'] or params['added']:
+                keys = sorted(list(params['changed'].keys()) + list(params['missing'].keys()) + list(params['added'].keys()))
+                return {'action':'update','host':vm['name'],'reason':'params out of sync : %s' % ', '.join(keys)}
+            tags = [p['value'] for p in vm['status']['remote'].get('parameters',[]) if p['name'] == SETUP_PARAM]
+            if self.identity and tags != [self.identity]:
+                return {'action':'update','host':vm['name'],'reason':'not tagged as part of setup'}
+
+        actions = []
+        for r in self._run(hostPlan,self.setup['hosts']):
+            if r.exception:
+                raise r.exception
+            if r.result:
+                actions.append(r.result)
+        # created and rebuilt hosts get new IP, params of hosts referring to them have to follow
+        recreated = set(a['host'] for a in actions if a['action'] in ('create','rebuild'))
+        planned = set(a['host'] for a in actions)
+        for vm in self.setup['hosts']:
+            refs = recreated.intersection(self._references(vm))
+            if refs and vm['name'] not in planned:
+                actions.append({'action':'update','host':vm['name'],'reason':'refers to recreated %s' % ', '.join(sorted(refs))})
+        if not self.identity:
+            self.log.warning('Setup %s has no identity, hosts removed from it are not deleted',self.name)
+            return actions
+        # hosts tagged by this setup which are no longer part of it
+        names = set('%s.%s' % (vm['name'],vm['domain']) for vm in self.setup['hosts'])
+        for host in self.foreman.paginate('/api/hosts',search='params.%s = "%s"' % (SETUP_PARAM,self.identity)):
+            if host['name'] not in names:
+                actions.append({'action':'delete','host':host['name'],'reason':'not part of setup anymore','id':host['id']})
+        return actions
+
+    def planActions(self,actions):
+        """Returns actions of plan as shown to user (without ids and params)"""
+        return [dict((k,v) for k,v in a.items() if k in ('action','host','reason')) for a in actions]
+
+    def showPlan(self,actions,format='text'):
+        if format == 'json':
+            print(json.dumps({'setup':self.name,'actions':self.planActions(actions)},indent=2))
+            return
+        self.log.info('Plan for setup : %s', self.name)
+        if not actions:
+            self.log.info(' Setup is up to date, nothing to do')
+        for a in actions:
+            self.log.info(' %-8s %s : %s',a['action'],a['host'],a['reason'])
+
+    def _updateHost(self,vm):
+        """Brings params of existing host in sync in single PUT, hosts params refer to must exist"""
+        params = self._outOfSync(vm)['params']
+        ids = dict((p['name'],p['id']) for p in vm['status']['remote'].get('parameters',[]))
+        attrs = []
+        for key in params['changed'].keys():
+            attrs.append({'id':ids[key],'name':key,'value':self._resolveExpr(vm['params'][key])})
+        for key in params['missing'].keys():
+            attrs.append({'name':key,'value':self._resolveExpr(vm['params'][key])})
+        for key in params['added'].keys():
+            attrs.append({'id':ids[key],'_destroy':True})
+        tags = [p['value'] for p in vm['status']['remote'].get('parameters',[]) if p['name'] == SETUP_PARAM]
+        if self.identity and tags != [self.identity]:
+            # tag hosts created before setup had identity (or by older versions tagging by file name)
+            if SETUP_PARAM in ids:
+                attrs.append({'id':ids[SETUP_PARAM],'name':SETUP_PARAM,'value':self.identity})
+            else:
+                attrs.append({'name':SETUP_PARAM,'value':self.identity})
+        if not attrs:
+            # params got in sync meanwhile (i.e. referred host was recreated with the same IP)
+            return True
+        self.log.info(' Updating params of %s',vm['name'])
+        r = self.foreman.put('/api/hosts/%d' % vm['status']['remote']['id'],{'host':{'host_parameters_attributes':dict((str(i),a) for i,a in enumerate(attrs))}})
+        if r.status_code != 200:
+            raise Exception('Failed to update %s, server returned %d : %s' % (vm['name'],r.status_code,r.text))
+        with self.lock:
+            vm['status']['remote'] = r.json()
+        return True
+
+    @tracedPhase
+    def apply(self,engine=None):
+        """Computes plan and runs only actions it contains. Hosts to be created or rebuilt are
+        installed by engine (defaults to self), params are updated once hosts they refer to exist"""
+        engine = engine or self
+        actions = self.plan()
+        self.showPlan(actions)
+        if not actions:
+            return
+        self.log.info('Applying plan for setup : %s', self.name)
+        hosts = dict((vm['name'],vm) for vm in self.setup['hosts'])
+        deletes = [a for a in actions if a['action'] == 'delete']
+        rebuilds = [hosts[a['host']] for a in actions if a['action'] == 'rebuild']
+        updates = [hosts[a['host']] for a in actions if a['action'] == 'update']
+
+        def deleteHost(action):
+            self.log.info(' Destroying %s' % action['host'])
+            r = self.foreman.delete('/api/hosts/%d' % action['id'])
+            # 404 means host was deleted meanwhile (or by lost attempt of retried DELETE)
+            if r.status_code not in (200,404):
+                self.log.error('Failed to destroy %s, server returned %d : %s',action['host'],r.status_code,r.text)
+                return
+            return True
 
+        deleted = run_parallel(self._slotted(deleteHost),[(a,) for a in deletes],self.parallel)
+        with self.lock:
+            self.failed.extend(r.args[0]['host'] for r in deleted if not r.ok)
+        success = all(r.ok for r in deleted)
+        success &= self._succeeded(self._run(self._destroyHost,rebuilds))
+        if [a for a in actions if a['action'] in ('create','rebuild')]:
+            engine.install()
+        # values of params are resolved now, when created and rebuilt hosts have their IPs
+        success &= self._succeeded(self._run(self._updateHost,updates))
+        if success and not self.failed:
+            self.log.info('Plan applied')
 
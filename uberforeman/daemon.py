@@ -0,0 +1,271 @@
+"""This module contains uberforeman daemon keeping foreman clients, catalogs and loaded setups warm
+
+Daemon listens on Unix-domain socket, CLI forwards its command line to it and prints output streamed back.
+Commands are executed one at a time, output of the whole daemon (including worker threads) goes to client
+of current command. Client arriving while a command runs is told the daemon is busy and runs its command
+in-process, client disconnecting (i.e. interrupted by Ctrl+C) cancels its command.
+"""
+import os, sys, json, socket, signal, argparse, traceback
+from threading import Lock, Thread, Event
+from .cache import CACHE_DIR
+
+# control socket of daemon
+SOCKET_PATH = os.path.join(CACHE_DIR,'daemon.sock')
+
+class Channel(object):
+    """Newline delimited JSON messages sent over a socket"""
+
+    def __init__(self,sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = Lock()
+
+    def send(self,**message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        """Returns next message or None when peer closed connection"""
+        line = self.reader.readline()
+        if not line:
+            return None
+        return json.loads(line.decode('utf-8'))
+
+class StreamProxy(object):
+    """Replaces sys.stdout/sys.stderr of daemon, writes go to channel of current command if there is one"""
+
+    def __init__(self,stream,key):
+        self.stream = stream
+        self.key = key
+        self.channel = None
+
+    def write(self,text):
+        channel = self.channel
+        if channel is not None:
+            try:
+                channel.send(**{self.key:text})
+                return
+            except EnvironmentError:
+                # client went away, command keeps running and writes to daemon's own stream
+                self.channel = None
+        self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self,name):
+        return getattr(self.stream,name)
+
+class Daemon(object):
+    """
+    Executes commands received on control socket. ForemanClient (connection pools, catalog indexes) is kept
+    per foreman login, Uberforeman (parsed setup with defaults applied and memoized lookups) per setup file.
+    Setup is validated by every command, so state of hosts is always fresh. Catalogs are kept until their
+    cache TTL expires, loaded setups are then dropped too, as they refer to objects of the old catalogs.
+    """
+    def __init__(self,path=SOCKET_PATH):
+        self.path = path
+        self.clients = {}
+        # setup path to (key, Uberforeman), key changes with file, login or host defaults
+        self.setups = {}
+        # commands are executed one at a time
+        self.lock = Lock()
+        # (channel, Uberforeman) of running command, command is cancelled when its client disconnects
+        self.current = None
+        self.stdout = StreamProxy(sys.stdout,'out')
+        self.stderr = StreamProxy(sys.stderr,'err')
+
+    def client(self,settings,args):
+        """Returns warm ForemanClient of given login, connection is tested when client is created"""
+        from .uberforeman import createClient
+        from .defaults import PARALLEL
+        key = (settings['url'],settings['user'],settings['password'])
+        foreman = self.clients.get(key)
+        if foreman is None:
+            foreman = createClient(settings,max(PARALLEL,args.parallel))
+            foreman.testConnection()
+            self.clients[key] = foreman
+        elif foreman.expireCatalogs(args.refresh_cache):
+            self.setups = dict((path,(k,fc)) for path,(k,fc) in self.setups.items() if fc.foreman is not foreman)
+        foreman.cache.refresh = args.refresh_cache
+        return foreman
+
+    def uberforeman(self,foreman,args,settings,cwd):
+        """Returns Uberforeman of setup given by args, loaded setup is reused until setup file changes"""
+        from .uberforeman import loadSetup
+        from .controller import Uberforeman
+        from .journal import Journal, setupKey
+        path = args.setup
+        url = path.find('http://') == 0 or path.find('https://') == 0
+        if not url:
+            path = os.path.join(cwd,path)
+        def load():
+            return Uberforeman(foreman,loadSetup(path),os.path.basename(path),settings['hostDefaults'],args.parallel,Journal.forSetup(path),setupKey(path))
+        if url:
+            return load()
+        st = os.stat(path)
+        key = (st.st_mtime,st.st_size,json.dumps(settings['hostDefaults'],sort_keys=True))
+        cached = self.setups.get(path)
+        if cached is None or cached[0] != key or cached[1].foreman is not foreman:
+            cached = self.setups[path] = (key,load())
+        return cached[1]
+
+    def execute(self,request,channel):
+        """Runs command line of request, its output is sent to channel followed by exit code"""
+        from .uberforeman import parseArgs, readConfig, perform
+        code = 0
+        if not self.lock.acquire(False):
+            # commands may run for tens of minutes, client does not wait for them
+            channel.send(fallback='busy')
+            return
+        try:
+            self.stdout.channel = self.stderr.channel = channel
+            args = None
+            fc = None
+            try:
+                args = parseArgs(request['argv'])
+                settings = readConfig(args)
+                if not settings['user'] or not settings['url'] or not settings['password']:
+                    # CLI reports missing login or asks for password itself
+                    channel.send(fallback='login')
+                    return
+                foreman = self.client(settings,args)
+                fc = self.uberforeman(foreman,args,settings,request['cwd'])
+                self.current = (channel,fc)
+                perform(fc,args)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code,int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+                fc = None
+            finally:
+                self.current = None
+                if args and (fc is None or fc.cancelled.is_set()):
+                    # host state of failed or cancelled command is not trusted, setup is loaded again by next command
+                    self.setups.pop(os.path.join(request['cwd'],args.setup),None)
+                sys.stdout.flush()
+                self.stdout.channel = self.stderr.channel = None
+        finally:
+            self.lock.release()
+        channel.send(exit=code)
+
+    def _watchClient(self,channel,done):
+        """Cancels running command once its client disconnects before command is done"""
+        try:
+            channel.receive()
+        except (EnvironmentError,ValueError):
+            pass
+        current = self.current
+        if not done.is_set() and current is not None and current[0] is channel:
+            self.stderr.stream.write('uberforeman daemon: client disconnected, cancelling command\n')
+            current[1].cancel()
+
+    def handle(self,sock):
+        channel = Channel(sock)
+        done = Event()
+        try:
+            request = channel.receive()
+            if request is not None:
+                # client sends nothing more, end of its stream means it went away
+                watcher = Thread(target=self._watchClient,args=(channel,done))
+                watcher.daemon = True
+                watcher.start()
+                self.execute(request,channel)
+        except EnvironmentError:
+            pass
+        finally:
+            done.set()
+            sock.close()
+
+    def serve(self):
+        """Listens on control socket until interrupted"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            if _connect(self.path):
+                sys.stderr.write('uberforeman daemon is already running on %s\n' % self.path)
+                sys.exit(1)
+            # left behind by daemon which was killed
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        # socket is accessible by current user only
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        signal.signal(signal.SIGINT,self._stop)
+        signal.signal(signal.SIGTERM,self._stop)
+        sys.stderr.write('uberforeman daemon listening on %s\n' % self.path)
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        try:
+            while True:
+                sock = server.accept()[0]
+                t = Thread(target=self.handle,args=(sock,))
+                t.daemon = True
+                t.start()
+        finally:
+            server.close()
+            os.remove(self.path)
+
+    def _stop(self,signum,frame):
+        self.stderr.stream.write('uberforeman daemon stopped\n')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        # commands may be waiting for hosts to get installed, do not wait for them
+        os._exit(0)
+
+def _connect(path):
+    """Returns socket connected to daemon or None when daemon is not running"""
+    if not hasattr(socket,'AF_UNIX') or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def forward(path,argv):
+    """Executes command line by daemon listening on path, prints output it streams back
+
+    :return: exit code of the command or None when daemon is not running or asks to run command in-process
+    """
+    sock = _connect(path)
+    if sock is None:
+        return None
+    channel = Channel(sock)
+    try:
+        channel.send(argv=argv,cwd=os.getcwd())
+        while True:
+            message = channel.receive()
+            if message is None:
+                sys.stderr.write('uberforeman daemon closed connection\n')
+                return 1
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+            elif 'fallback' in message:
+                if message['fallback'] == 'busy':
+                    sys.stderr.write('uberforeman daemon is busy with another command, running in-process\n')
+                return None
+            elif 'exit' in message:
+                return message['exit']
+    finally:
+        sock.close()
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog='uberforeman serve', description='Runs daemon executing uberforeman commands with warm connections and caches')
+    parser.add_argument('--socket', metavar='PATH', help='Control socket (default %s)' % SOCKET_PATH, default=SOCKET_PATH)
+    args = parser.parse_args(argv)
+    Daemon(args.socket).serve()
@@ -1,4 +1,13 @@
 
+# max number of hosts processed in parallel
+PARALLEL = 20
+
+# max number of foreman and oVirt resources fetched in parallel before setup is validated
+PREFETCH_PARALLEL = 8
+
+# name of host parameter carrying name of setup host belongs to
+SETUP_PARAM = 'uberforeman_setup'
+
 # defaults for VM definition in setup
 VM_DEFAULT = {
         "computeResource":"rhevm",
@@ -13,6 +22,9 @@ VM_DEFAULT = {
         "image":""
         }
 
+# host attributes foreman payload is built from, hosts equal in these share the payload
+PAYLOAD_ATTRS = ('hostGroup','computeResource','image','domain','cluster','storage','disk','ram','cpus')
+
 # defaults for foreman VM representation
 FOREMAN_DEFAULT = {
         "name" : "simple-host1",
@@ -0,0 +1,363 @@
+"""This module contains local stand-in for foreman API and host readiness services used by benchmarks
+
+FakeForeman implements subset of foreman API used by ForemanClient (hosts, hostgroups, domains,
+compute_resources with their images, clusters and storage domains, power and orchestration tasks) backed by
+in-memory database.
+FakeReadiness emulates http service hosts run on port 49999 while being installed. Every fake host
+gets its own loopback address (127.x.y.z), so single FakeReadiness serves all of them (Linux only).
+
+Run ``python -m uberforeman.fakeforeman --help`` to serve them standalone.
+"""
+import json, random, re, sys, threading, time, argparse
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # python 2.x fallback
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from .defaults import VM_DEFAULT
+
+READINESS_PORT = 49999
+
+class Settings(object):
+    """Behavior of fake services"""
+
+    def __init__(self,latency=0.0,jitter=0.0,errorRate=0.0,createTime=0.0,installTime=5.0,listing=True,capacity=0,powerRate=0,lostRate=0.0):
+        """Creates new instance
+
+        :param latency: seconds each foreman request takes
+        :param jitter: max random seconds added to latency
+        :param errorRate: fraction of foreman requests failing with 503
+        :param createTime: seconds POST /api/hosts takes (orchestration tasks run meanwhile)
+        :param installTime: seconds host is installing after it is powered on
+        :param listing: whether readiness service provides directory listing
+        :param capacity: max concurrent requests, more are rejected by 503 (0 means unlimited)
+        :param lostRate: fraction of foreman requests processed but answered by 504 (response lost)
+        :param powerRate: max power on actions per second, more are asked to try again later (0 means unlimited)
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.createTime = createTime
+        self.installTime = installTime
+        self.listing = listing
+        self.capacity = capacity
+        self.powerRate = powerRate
+        self.lostRate = lostRate
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class FakeDatabase(object):
+    """In-memory foreman data and request counters shared by both fake services"""
+
+    def __init__(self,settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.hostgroups = [
+            {'id':1,'name':'Server','title':'bench/Server','label':'bench/Server','subnet_id':1},
+            {'id':2,'name':'Agent','title':'bench/Agent','label':'bench/Agent','subnet_id':1}]
+        self.computeResources = [{'id':1,'name':VM_DEFAULT['computeResource'],'provider':'oVirt','url':'https://rhevm/api','user':'admin'}]
+        self.domains = [{'id':1,'name':VM_DEFAULT['domain']}]
+        self.images = [{'id':1,'name':'rhel','uuid':'00000000-0000-0000-0000-000000000001','operatingsystem_id':1}]
+        self.clusters = [{'id':'00000000-0000-0000-0001-%012d' % i,'name':name} for i,name in enumerate(['userspace','automation','performance'])]
+        self.storages = [{'id':'00000000-0000-0000-0002-%012d' % i,'name':name} for i,name in enumerate(['BC_shared','BC_perf'])]
+        self.hosts = {}
+        self.byIp = {}
+        self.tasks = {}
+        self.nextId = 1
+        self.requests = {}
+        self.inflight = 0
+        self.powerOns = []
+
+    def count(self,method,path):
+        """Counts request, paths are normalized so ids do not make separate entries"""
+        path = re.sub('/orchestration/[^/]+','/orchestration/:uuid',path)
+        path = re.sub('/[0-9]+','/:id',path)
+        key = '%s %s' % (method,path)
+        with self.lock:
+            self.requests[key] = self.requests.get(key,0) + 1
+
+    def stats(self):
+        with self.lock:
+            hosts = list(self.hosts.values())
+            return {
+                'requests':dict(self.requests),
+                'hosts':len(hosts),
+                'poweredOn':len([h for h in hosts if h['power'] == 'up']),
+                'installed':len([h for h in hosts if self.readiness(h) == 'installed'])}
+
+    def powerBusy(self):
+        """Returns true if power on action exceeds powerRate"""
+        if not self.settings.powerRate:
+            return False
+        with self.lock:
+            now = time.time()
+            self.powerOns = [t for t in self.powerOns if now - t < 1]
+            if len(self.powerOns) >= self.settings.powerRate:
+                return True
+            self.powerOns.append(now)
+            return False
+
+    def _ip(self,id):
+        return '127.%d.%d.%d' % (1 + id // 62500,(id // 250) % 250,id % 250 + 1)
+
+    def create(self,attrs):
+        with self.lock:
+            id = self.nextId
+            self.nextId += 1
+            domain = [d['name'] for d in self.domains if str(d['id']) == str(attrs.get('domain_id'))] or [VM_DEFAULT['domain']]
+            params = list((attrs.get('host_parameters_attributes') or {}).values())
+            host = {
+                'id':id,
+                'name':'%s.%s' % (attrs['name'],domain[0]),
+                'ip':self._ip(id),
+                'hostgroup_id':int(attrs['hostgroup_id']),
+                'build':True,
+                'provision_method':attrs.get('provision_method','build'),
+                'image_name':attrs.get('image_id') and self.images[0]['name'],
+                'parameters':[{'id':i + 1,'name':p['name'],'value':p['value']} for i,p in enumerate(params)],
+                'power':'down',
+                'poweredOn':None}
+            if host['provision_method'] == 'image':
+                self._powerOn(host)
+            self.hosts[id] = host
+            self.byIp[host['ip']] = host
+            return host
+
+    def _powerOn(self,host):
+        if host['power'] != 'up':
+            host['power'] = 'up'
+            host['poweredOn'] = time.time()
+
+    def power(self,id,action):
+        with self.lock:
+            host = self.hosts[id]
+            if action == 'start':
+                self._powerOn(host)
+            elif action == 'stop':
+                host['power'] = 'down'
+                host['poweredOn'] = None
+            return host['power']
+
+    def readiness(self,host):
+        """Returns 'down', 'installing' or 'installed'"""
+        if host is None or host['poweredOn'] is None:
+            return 'down'
+        if time.time() - host['poweredOn'] < self.settings.installTime:
+            return 'installing'
+        return 'installed'
+
+class FakeForemanHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,*args):
+        pass
+
+    def _reply(self,obj,code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def _handle(self,method):
+        db = self.server.db
+        settings = db.settings
+        url = urlparse(self.path)
+        body = self._body() if method in ('POST','PUT') else {}
+        if url.path.startswith('/_bench/'):
+            return self._reply(db.stats())
+        db.count(method,url.path)
+        with db.lock:
+            db.inflight += 1
+            overloaded = settings.capacity and db.inflight > settings.capacity
+        try:
+            if overloaded:
+                return self._reply({'error':{'message':'Service Unavailable (over capacity)'}},503)
+            time.sleep(settings.latency + random.random() * settings.jitter)
+            if settings.errorRate and random.random() < settings.errorRate:
+                return self._reply({'error':{'message':'Service Unavailable (injected)'}},503)
+            parts = url.path.strip('/').split('/')
+            if parts[-1] == 'power' and body.get('power_action') == 'start' and db.powerBusy():
+                return self._reply({'error':{'message':'Failed to power up: Please try again in a few minutes'}},500)
+            try:
+                result = getattr(self,'_%s' % method.lower())(db,parts,parse_qs(url.query),body)
+            except KeyError:
+                return self._reply({'error':{'message':'Resource not found'}},404)
+            if settings.lostRate and random.random() < settings.lostRate:
+                return self._reply({'error':{'message':'Gateway Timeout (injected)'}},504)
+            self._reply(result)
+        finally:
+            with db.lock:
+                db.inflight -= 1
+
+    def _page(self,items,query):
+        perPage = int(query.get('per_page',['20'])[0])
+        page = int(query.get('page',['1'])[0])
+        return {'results':items[(page - 1) * perPage:page * perPage],'total':len(items),'subtotal':len(items),'page':page,'per_page':perPage}
+
+    def _search(self,hosts,search):
+        m = re.match('name \\^ \\((.*)\\)$',search)
+        if m:
+            names = set(m.group(1).split(','))
+            return [h for h in hosts if h['name'] in names]
+        m = re.match('params\\.(\\S+) = "(.*)"$',search)
+        if m:
+            return [h for h in hosts if {'name':m.group(1),'value':m.group(2)} in [{'name':p['name'],'value':p['value']} for p in h['parameters']]]
+        return hosts
+
+    def _get(self,db,parts,query,body):
+        if parts == ['api']:
+            return {'links':{}}
+        if parts[:2] == ['api','orchestration']:
+            started = db.tasks[parts[2]]
+            names = ['Set up compute instance','Acquire IP address','Query instance details','Create DHCP reservation']
+            done = len(names) if not db.settings.createTime else int((time.time() - started) / db.settings.createTime * len(names))
+            return self._page([{'name':n,'status':'completed' if i < done else ('running' if i == done else 'pending')} for i,n in enumerate(names)],query)
+        if parts[:2] == ['api','hosts'] and len(parts) == 3:
+            with db.lock:
+                return dict(db.hosts[int(parts[2])])
+        if parts == ['api','hosts']:
+            with db.lock:
+                hosts = sorted(db.hosts.values(),key=lambda h: h['id'])
+            return self._page(self._search(hosts,query.get('search',[''])[0]),query)
+        if parts[:2] == ['api','compute_resources'] and len(parts) == 4:
+            resources = {'images':db.images,'available_clusters':db.clusters,'available_storage_domains':db.storages}
+            return self._page(resources[parts[-1]],query)
+        catalogs = {'hostgroups':db.hostgroups,'compute_resources':db.computeResources,'domains':db.domains}
+        return self._page(catalogs[parts[-1]],query)
+
+    def _post(self,db,parts,query,body):
+        attrs = body['host']
+        if attrs.get('progress_report_id'):
+            db.tasks[attrs['progress_report_id']] = time.time()
+        time.sleep(db.settings.createTime)
+        return db.create(attrs)
+
+    def _put(self,db,parts,query,body):
+        id = int(parts[2])
+        if parts[-1] == 'power':
+            return {'power':db.power(id,body['power_action'])}
+        attrs = body.get('host',body)
+        with db.lock:
+            host = db.hosts[id]
+            for a in (attrs.pop('host_parameters_attributes',None) or {}).values():
+                if a.get('_destroy'):
+                    host['parameters'] = [p for p in host['parameters'] if p['id'] != a['id']]
+                elif 'id' in a:
+                    for p in host['parameters']:
+                        if p['id'] == a['id']:
+                            p['value'] = a['value']
+                else:
+                    host['parameters'].append({'id':max([p['id'] for p in host['parameters']] + [0]) + 1,'name':a['name'],'value':a['value']})
+            host.update(attrs)
+            return dict(host)
+
+    def _delete(self,db,parts,query,body):
+        with db.lock:
+            host = db.hosts.pop(int(parts[2]))
+            db.byIp.pop(host['ip'],None)
+            return {}
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+class FakeReadinessHandler(BaseHTTPRequestHandler):
+    """Serves /tmp of fake host, connections of hosts which are not powered on are dropped"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,*args):
+        pass
+
+    def do_GET(self):
+        db = self.server.db
+        db.count('PROBE',urlparse(self.path).path)
+        ip = self.connection.getsockname()[0]
+        with db.lock:
+            state = db.readiness(db.byIp.get(ip))
+        if state == 'down':
+            self.close_connection = True
+            return
+        files = state == 'installing' and ['.installing'] or []
+        if self.path == '/' and db.settings.listing:
+            body = ''.join('<a href="%s">%s</a>\n' % (f,f) for f in files + ['anaconda.log'])
+            code = 200
+        else:
+            body = ''
+            code = self.path.lstrip('/') in files and 200 or 404
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeForeman(object):
+    """Fake foreman and readiness services running on background threads"""
+
+    def __init__(self,settings=None,port=0,readinessPort=READINESS_PORT):
+        self.settings = settings or Settings()
+        self.db = FakeDatabase(self.settings)
+        self.server = ThreadingServer(('127.0.0.1',port),FakeForemanHandler)
+        self.server.db = self.db
+        self.readiness = ThreadingServer(('',readinessPort),FakeReadinessHandler)
+        self.readiness.db = self.db
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        for server in (self.server,self.readiness):
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        for server in (self.server,self.readiness):
+            server.shutdown()
+            server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves fake foreman API and host readiness services')
+    parser.add_argument('--port', type=int, default=0, help='Port of foreman API (default random)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds each foreman request takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Max random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of foreman requests failing with 503')
+    parser.add_argument('--create-time', type=float, default=0.0, help='Seconds host creation takes')
+    parser.add_argument('--install-time', type=float, default=5.0, help='Seconds host installs after power on')
+    parser.add_argument('--no-listing', action='store_true', help='Readiness service does not provide directory listing')
+    parser.add_argument('--capacity', type=int, default=0, help='Max concurrent requests, more are rejected by 503 (default unlimited)')
+    parser.add_argument('--power-rate', type=int, default=0, help='Max power on actions per second, more are asked to try again later (default unlimited)')
+    parser.add_argument('--lost-rate', type=float, default=0.0, help='Fraction of foreman requests processed but answered by 504')
+    args = parser.parse_args(argv)
+    settings = Settings(args.latency,args.jitter,args.error_rate,args.create_time,args.install_time,not args.no_listing,args.capacity,args.power_rate,args.lost_rate)
+    fake = FakeForeman(settings,args.port).start()
+    # parent process (benchmark) reads URL from first line
+    print(fake.url)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""This module contains compact representation of hosts sharing structure with defaults and clone templates
+
+"""
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # python 2.x fallback
+    from collections import MutableMapping
+
+# marks key deleted from overlay while still present in its base
+_DELETED = object()
+
+class Overlay(MutableMapping):
+    """
+    Dict-like view of own attributes laid over shared base mapping. Reads fall through to base,
+    writes and deletes only touch own attributes, so base (defaults, clone template or shared foreman
+    payload) is never copied nor modified. Nested values are shared with base and must be replaced
+    rather than modified in place.
+    """
+    __slots__ = ('_base','_own')
+
+    def __init__(self,base,own=None):
+        self._base = base
+        self._own = {} if own is None else own
+
+    def derive(self,own=None):
+        """Returns new overlay based on this one"""
+        return Overlay(self,own)
+
+    def __getitem__(self,key):
+        if key in self._own:
+            value = self._own[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._base[key]
+
+    def __setitem__(self,key,value):
+        self._own[key] = value
+
+    def __delitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self._own[key] = _DELETED
+        else:
+            del self._own[key]
+
+    def __contains__(self,key):
+        if key in self._own:
+            return self._own[key] is not _DELETED
+        return key in self._base
+
+    def __iter__(self):
+        for key,value in self._own.items():
+            if value is not _DELETED:
+                yield key
+        for key in self._base:
+            if key not in self._own:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return 'Overlay(%r)' % dict(self)
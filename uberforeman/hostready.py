@@ -1,13 +1,31 @@
 """This module contains various classes detecting state of host in sense of being installed.
 
 """
-import sys, time, random
+import sys, time, random, re, heapq
+from threading import Condition, Lock, Thread
+from concurrent.futures import ThreadPoolExecutor, Future
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError,Timeout
+from .trace import tracer, PROBE, TASK, WAIT
 
 # VM installation timeout in seconds
 INSTALL_TIMEOUT=30*60 #30 minutes
 
+# number of readiness probes running in parallel
+PROBE_PARALLEL = 16
+# interval between probes of single host grows from min to max (seconds) while its status does not change
+PROBE_MIN_INTERVAL = 2
+PROBE_MAX_INTERVAL = 30
+PROBE_BACKOFF = 1.5
+# probed hosts whose connections are kept (one pool per host), hosts beyond that evict pools of others
+PROBE_HOSTS = 1024
+# connections kept per probed host, host is probed by one thread at a time
+PROBE_HOST_CONNECTIONS = 2
+
+# seconds between polling rounds of orchestration tasks
+TASK_POLL_INTERVAL = 5
+
 class HostReady(object):
 
     def __init__(self,foreman):
@@ -27,48 +45,182 @@ class HostReady(object):
     def waitForInstalled(self,host,name):
         pass
 
-class ImageBasedVMHostReady(HostReady):
+    def whenInstalled(self,host,name,cancelled=None):
+        """Returns Future resolved with status of host once it gets installed
+
+        :param cancelled: optional Event, future fails once it is set
+        """
+        future = Future()
+        self.waitForInstalled(host,name)
+        future.set_result(self.getStatus(host))
+        return future
+
+
+class ReadinessPoller(object):
     """
-    This class detects host status based on orchestration uuid, so this implementation is host specific,
-    thus host arguments are ignored
+    Single thread scheduling readiness probes of all hosts being waited for. Probes run on a small
+    pool of threads, interval of each host grows while its status does not change and is reset once it
+    changes. Listeners of host are called after each of its probes, host is probed while it has any.
     """
-    def __init__(self,foreman,task_uuid):
-        self.foreman = foreman
-        self.uuid = task_uuid
-        self.tasks = None
+    def __init__(self,probe,parallel=PROBE_PARALLEL,minInterval=PROBE_MIN_INTERVAL,maxInterval=PROBE_MAX_INTERVAL):
+        """Creates new instance
 
-    def isInstalled(self,host):
-        return self.getStatus(host) == 'INSTALLED'
+        :param probe: function returning status of given host
+        """
+        self.probe = probe
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.cond = Condition()
+        self.hosts = {}
+        self.heap = []
+        self.executor = ThreadPoolExecutor(max_workers=parallel)
+        self.thread = None
 
-    def getStatus(self,host):
+    def subscribe(self,host,listener):
+        """Starts probing host, listener(status) is called after every probe until it returns True"""
+        with self.cond:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = {'status':None,'interval':self.minInterval,'listeners':[],'due':time.time()}
+                heapq.heappush(self.heap,(state['due'],host))
+            state['listeners'].append(listener)
+            if self.thread is None:
+                self.thread = Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _notify(self,listener,status):
         try:
-            self.tasks = self.foreman.task(self.uuid,status='running')
-            if len(self.tasks) > 0:
-                return self.tasks[0]['name']
+            return listener(status)
+        except Exception:
+            # broken listener is dropped, it must not stop probing of others
+            return True
+
+    def _probed(self,host,status):
+        with self.cond:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            if state['status'] == status:
+                state['interval'] = min(state['interval'] * PROBE_BACKOFF,self.maxInterval)
             else:
-                return 'INSTALLED'
-        except:
-            pass # not found?
-            if self.tasks:
-                return 'INSTALLED' # if we previously retrieved task and now the task does not exist anymore, we're done
-            return 'N/A'
-        return 'N/A'
-    
-    def waitForInstalled(self,host,name):
-        t = 0
-        t0 = int(time.time())
-        while t < INSTALL_TIMEOUT:
-            status = self.getStatus(host)
-            if status.find('INSTALLED') == 0:
-                print('VM Ready')
+                state['status'] = status
+                state['interval'] = self.minInterval
+            listeners = list(state['listeners'])
+        # listeners run outside of lock, they may complete futures running arbitrary callbacks
+        done = [listener for listener in listeners if self._notify(listener,status)]
+        with self.cond:
+            for listener in done:
+                state['listeners'].remove(listener)
+            if not state['listeners']:
+                del self.hosts[host]
                 return
-            print('%s (%ds)' % (status,t))
-            time.sleep(random.randint(1,5))
-            now = int(time.time())
-            t+= now - t0
-            t0 = now
-        raise Exception('VM installation reached timeout %ds, something is wrong' %  INSTALL_TIMEOUT)
+            state['due'] = time.time() + state['interval'] * random.uniform(0.8,1.2)
+            heapq.heappush(self.heap,(state['due'],host))
+            self.cond.notify_all()
+
+    def _probe(self,host):
+        try:
+            status = self.probe(host)
+        except Exception:
+            status = 'N/A'
+        self._probed(host,status)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    if self.heap:
+                        self.cond.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                due,host = heapq.heappop(self.heap)
+                state = self.hosts.get(host)
+                # skip hosts no longer watched and outdated entries
+                if state is None or state['due'] != due:
+                    continue
+            self.executor.submit(self._probe,host)
 
+class TaskTracker(object):
+    """
+    Tracks orchestration tasks (progress_report_id) of all hosts being created by polling them
+    on single shared schedule. Progress of each host is passed to listeners as event dict with keys
+    host, uuid, status ('running', 'completed', 'failed' or 'N/A'), task (name of running task),
+    done (number of finished tasks) and total. Listeners are called only when progress changes.
+    """
+    def __init__(self,foreman,interval=TASK_POLL_INTERVAL,parallel=PROBE_PARALLEL):
+        """Creates new instance
+
+        :param foreman: ForemanClient instance
+        :param interval: seconds between polling rounds
+        """
+        self.foreman = foreman
+        self.interval = interval
+        self.parallel = parallel
+        self.cond = Condition()
+        self.tracked = {}
+        self.events = {}
+        self.listeners = []
+        self.thread = None
+
+    def addListener(self,listener):
+        self.listeners.append(listener)
+
+    def track(self,uuid,host):
+        with self.cond:
+            self.tracked[uuid] = host
+            if self.thread is None:
+                self.thread = Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+    def untrack(self,uuid):
+        with self.cond:
+            self.tracked.pop(uuid,None)
+            self.events.pop(uuid,None)
+
+    def progress(self,uuid):
+        """Returns last event of given task or None"""
+        with self.cond:
+            return self.events.get(uuid)
+
+    def _event(self,uuid,host):
+        event = {'host':host,'uuid':uuid,'status':'N/A','task':None,'done':0,'total':0}
+        try:
+            tasks = list(self.foreman.paginate('/api/orchestration/%s/tasks' % uuid))
+        except Exception:
+            return event # not found yet
+        event['total'] = len(tasks)
+        event['done'] = len([t for t in tasks if t['status'] == 'completed'])
+        running = [t for t in tasks if t['status'] == 'running']
+        if [t for t in tasks if t['status'] == 'failed']:
+            event['status'] = 'failed'
+        elif running or event['done'] < event['total']:
+            event['status'] = 'running'
+            event['task'] = running and running[0]['name'] or None
+        else:
+            event['status'] = 'completed'
+        return event
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.parallel)
+        while True:
+            with self.cond:
+                while not self.tracked:
+                    self.cond.wait()
+                tracked = list(self.tracked.items())
+            with tracer.span('poll tasks',TASK,tasks=len(tracked)):
+                events = list(executor.map(lambda item: self._event(*item),tracked))
+            for event in events:
+                with self.cond:
+                    if event['uuid'] not in self.tracked or self.events.get(event['uuid']) == event:
+                        continue
+                    self.events[event['uuid']] = event
+                for listener in self.listeners:
+                    listener(event)
+            time.sleep(self.interval)
 
 class JonBCHostReady(HostReady):
     """
@@ -77,40 +229,93 @@ class JonBCHostReady(HostReady):
      in VM kickstarts there is a logic witch creates '.installing' when post-installation
      runs and removes it when it's done. There might also appear '.installation_error'
      which denotes installation failure
+
+    Status is read from directory listing in single request when http service provides it,
+    hosts being waited for are probed by shared ReadinessPoller.
     """
+    def __init__(self,foreman):
+        HostReady.__init__(self,foreman)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=PROBE_HOSTS,pool_maxsize=PROBE_HOST_CONNECTIONS)
+        self.session.mount('http://',adapter)
+        # hosts known not to provide directory listing
+        self.noListing = set()
+        self.lock = Lock()
+        self.poller = None
+
     def isInstalled(self,host):
         return self.getStatus(host).find('INSTALLED') == 0
 
+    def _errorStatus(self,base):
+        r = self.session.get(base + '.installation_error',timeout=2)
+        if r.status_code == 200:
+            return 'INSTALLED FAILED : %s' % r.text
+
     def getStatus(self,host):
-        status = 'http://%s:49999/.installing' % (host.rstrip('/'))
+        with tracer.span('probe',PROBE,host=host) as args:
+            args['status'] = self._getStatus(host)
+            return args['status']
+
+    def _getStatus(self,host):
+        base = 'http://%s:49999/' % (host.rstrip('/'))
         try:
-            r = requests.get(status,timeout=2)
+            if host not in self.noListing:
+                r = self.session.get(base,timeout=2)
+                if r.status_code == 200 and r.text.find('<a href') >= 0:
+                    if re.search('href="\\.installation_error"',r.text):
+                        return self._errorStatus(base) or 'INSTALLED'
+                    if re.search('href="\\.installing"',r.text):
+                        return 'INSTALLING'
+                    return 'INSTALLED'
+                self.noListing.add(host)
+            r = self.session.get(base + '.installing',timeout=2)
             if r.status_code == 404:
-                r = requests.get('http://%s:49999/.installation_error' % (host.rstrip('/')),timeout=2)
-                if r.status_code == 200:
-                    return 'INSTALLED FAILED : %s' % r.text
-                return 'INSTALLED'
+                return self._errorStatus(base) or 'INSTALLED'
             elif r.status_code == 200:
                 return 'INSTALLING'
         except Timeout:
             return 'N/A'
         except ConnectionError:
             return 'N/A'
-    
+        return 'N/A'
+
+    def _poller(self):
+        with self.lock:
+            if self.poller is None:
+                self.poller = ReadinessPoller(self.getStatus)
+            return self.poller
+
     def waitForInstalled(self,host,name):
-        t = 0
-        t0 = int(time.time())
-        while t < INSTALL_TIMEOUT:
-            status = self.getStatus(host)
-            if status.find('INSTALLED') == 0:
-                print('\n%s is %s' % (name,status))
-                return
-            print('%s is %s (%ds)...' % (name,status,t))
-            time.sleep(random.randint(1,5))
-            now = int(time.time())
-            t+= now - t0
-            t0 = now
-        raise Exception('VM installation reached timeout %ds, something is wrong' %  INSTALL_TIMEOUT)
+        self.whenInstalled(host,name).result()
 
+    def whenInstalled(self,host,name,cancelled=None):
+        """Returns Future resolved with status of host once it gets installed. No thread waits meanwhile,
+        host is probed by shared ReadinessPoller which resolves the future
 
+        :param cancelled: optional Event, future fails once it is set (checked after each probe)
+        """
+        future = Future()
+        t0 = time.time()
+        last = [None]
+
+        def probed(status):
+            if status is not None and status.find('INSTALLED') == 0:
+                print('\n%s is %s' % (name,status))
+                tracer.add('wait installed',WAIT,t0,time.time(),track=name)
+                future.set_result(status)
+                return True
+            if cancelled is not None and cancelled.is_set():
+                tracer.add('wait installed',WAIT,t0,time.time(),track=name)
+                future.set_exception(Exception('waiting for %s was cancelled' % name))
+                return True
+            if time.time() - t0 >= INSTALL_TIMEOUT:
+                tracer.add('wait installed',WAIT,t0,time.time(),track=name)
+                future.set_exception(Exception('VM installation reached timeout %ds, something is wrong' %  INSTALL_TIMEOUT))
+                return True
+            if status != last[0]:
+                last[0] = status
+                print('%s is %s (%ds)...' % (name,status,time.time() - t0))
+            return False
 
+        self._poller().subscribe(host,probed)
+        return future
@@ -0,0 +1,85 @@
+"""This module contains local journal of host lifecycle transitions used to resume interrupted install
+
+"""
+import os, json, time, hashlib, tempfile
+from threading import Lock
+from .cache import CACHE_DIR
+
+JOURNAL_DIR = os.path.join(CACHE_DIR,'journal')
+
+# host was created in foreman
+CREATED = 'created'
+# power on action succeeded
+POWERED_ON = 'poweredOn'
+# host reported it is installed
+INSTALLED = 'installed'
+
+def setupKey(setup):
+    """Returns identity of setup file (path or URL), hash of its absolute path or URL"""
+    if setup.find('http://') != 0 and setup.find('https://') != 0:
+        setup = os.path.abspath(setup)
+    return hashlib.sha1(setup.encode('utf-8')).hexdigest()
+
+class Journal(object):
+    """
+    Records lifecycle transitions of hosts of single setup file. Journal is a JSON file of
+    host name to dict of transition name to timestamp (and host id), rewritten on every change so it
+    survives interrupted runs.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+        try:
+            with open(path,'r') as fd:
+                self.entries = json.load(fd)
+        except (IOError,OSError,ValueError):
+            pass
+
+    @classmethod
+    def forSetup(cls,setup,directory=JOURNAL_DIR):
+        """Returns journal of given setup file (path or URL)"""
+        return cls(os.path.join(directory,setupKey(setup) + '.json'))
+
+    def _save(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory,0o700)
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd,'w') as f:
+                json.dump(self.entries,f,indent=1)
+            os.rename(tmp,self.path)
+        except (IOError,OSError):
+            pass # journal is optional, never fail because of it
+
+    def record(self,host,transition,**data):
+        with self.lock:
+            entry = self.entries.setdefault(host,{})
+            entry[transition] = time.time()
+            entry.update(data)
+            self._save()
+
+    def has(self,host,transition):
+        with self.lock:
+            return transition in self.entries.get(host,{})
+
+    def get(self,host):
+        with self.lock:
+            return dict(self.entries.get(host,{}))
+
+    def forget(self,host,*transitions):
+        """Forgets given transitions of host, whole entry when no transition is given"""
+        with self.lock:
+            if not transitions:
+                if self.entries.pop(host,None) is not None:
+                    self._save()
+                return
+            entry = self.entries.get(host,{})
+            if [entry.pop(t) for t in transitions if t in entry]:
+                self._save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self._save()
@@ -0,0 +1,194 @@
+"""This module contains adaptive client-side limiter of concurrent requests to foreman
+
+"""
+import time
+from threading import Condition
+from .trace import tracer, WAIT
+
+# max number of concurrent requests of each class, see requestClass()
+LIMITS = {'read':50,'write':20,'power':10,'create':20}
+# classes of requests taking long by nature (host creation waits for oVirt to create VM), their limit is
+# decreased on overload only, as latency does not tell whether foreman is congested
+SLOW_CLASSES = ('create',)
+# limit is halved on overload, reduced by this ratio when latency grows
+LATENCY_BACKOFF = 0.9
+OVERLOAD_BACKOFF = 0.5
+# latency this many times higher than baseline means foreman is getting congested
+LATENCY_TOLERANCE = 4
+# latency below this never counts as congestion (seconds)
+LATENCY_FLOOR = 0.5
+# limit is decreased at most once per interval (seconds)
+DECREASE_INTERVAL = 1
+# requests of overloaded class are paused, pause doubles while overload persists (seconds)
+PAUSE_MIN = 1
+PAUSE_MAX = 60
+# message of foreman 500 response asking to retry later (i.e. power on while oVirt is busy)
+RETRY_MESSAGE = 'Please try again in a few minutes'
+
+def requestClass(method,path):
+    """Returns class of request, each class has its own limit"""
+    path = path.rstrip('/')
+    if path.endswith('/power'):
+        return 'power'
+    if method == 'POST' and path.endswith('/api/hosts'):
+        return 'create'
+    if method in ('GET','HEAD'):
+        return 'read'
+    return 'write'
+
+def isOverload(status,text=''):
+    """Returns true if response status (and text) tells foreman is overloaded"""
+    if status in (429,502,503,504):
+        return True
+    return status == 500 and text.find(RETRY_MESSAGE) >= 0
+
+def retryAfter(headers):
+    """Returns seconds of Retry-After header or None"""
+    try:
+        return min(float(headers.get('Retry-After')),PAUSE_MAX)
+    except (TypeError,ValueError):
+        return None
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class AdaptiveLimiter(object):
+    """
+    AIMD concurrency limit of one class of requests. Limit grows by 1 per window of successful
+    requests, it is cut down when latency grows well above its baseline or when foreman reports
+    overload (429, 502-504 or 500 asking to try again). Overload also pauses all requests of the class,
+    so waiting for foreman is shared instead of each thread sleeping and retrying on its own.
+    """
+    def __init__(self,name,maximum,minimum=1,initial=None,latency=True):
+        """Creates new instance
+
+        :param latency: decrease limit when latency grows, otherwise on overload only
+        """
+        self.name = name
+        self.latency = latency
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or maximum)
+        self.inflight = 0
+        self.cond = Condition()
+        self.baseline = None
+        self.pause = 0
+        self.pausedUntil = 0
+        self.lastDecrease = 0
+        self.overloads = 0
+        self.waited = 0
+        # (loop, future) of coroutines waiting for slot, see acquireOrWait()
+        self.waiters = []
+
+    def acquire(self,blocking=True):
+        """Takes slot for one request, blocks while limit is reached or class is paused
+
+        :return: False if slot is not available and blocking is False
+        """
+        t0 = time.time()
+        blocked = False
+        with self.cond:
+            while True:
+                now = time.time()
+                if now < self.pausedUntil:
+                    timeout = self.pausedUntil - now
+                elif self.inflight < int(self.limit):
+                    self.inflight += 1
+                    break
+                else:
+                    timeout = None
+                if not blocking:
+                    return False
+                blocked = True
+                self.cond.wait(timeout)
+            if blocked:
+                self.waited += 1
+        if blocked:
+            tracer.add('wait limiter (%s)' % self.name,WAIT,t0,now)
+        return True
+
+    def acquireOrWait(self,loop):
+        """Non-blocking acquire() for coroutines running on given asyncio loop (called from its thread)
+
+        :return: None when slot was taken, otherwise asyncio Future resolved once it is worth trying
+        again (slot was released or pause is over)
+        """
+        with self.cond:
+            now = time.time()
+            if now >= self.pausedUntil and self.inflight < int(self.limit):
+                self.inflight += 1
+                return None
+            future = loop.create_future()
+            if now < self.pausedUntil:
+                loop.call_later(self.pausedUntil - now,_wake,future)
+            self.waiters.append((loop,future))
+            return future
+
+    def release(self,latency,overloaded=False,pause=None):
+        """Returns slot taken by acquire() and adjusts limit
+
+        :param latency: seconds request took
+        :param overloaded: foreman reported overload
+        :param pause: seconds to pause the class for (Retry-After), defaults to growing pause
+        """
+        with self.cond:
+            self.inflight -= 1
+            now = time.time()
+            if overloaded:
+                self.overloads += 1
+                if now >= self.pausedUntil:
+                    # requests running in parallel report same overload, grow pause once
+                    self.pause = min(PAUSE_MAX,max(PAUSE_MIN,self.pause * 2))
+                    self.pausedUntil = now + (pause or self.pause)
+                elif pause:
+                    self.pausedUntil = max(self.pausedUntil,now + pause)
+                self._decrease(now,OVERLOAD_BACKOFF)
+            else:
+                self.pause = 0
+                if self.latency and self._congested(latency):
+                    self._decrease(now,LATENCY_BACKOFF)
+                else:
+                    self.limit = min(self.maximum,self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop,future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake,future)
+            except RuntimeError:
+                pass # loop of waiter is already closed
+
+    def _congested(self,latency):
+        """Updates latency baseline, returns True if latency is well above it"""
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # let baseline follow slowly when foreman gets permanently slower
+            self.baseline += (latency - self.baseline) * 0.01
+        return latency > max(LATENCY_FLOOR,self.baseline * LATENCY_TOLERANCE)
+
+    def _decrease(self,now,ratio):
+        if now - self.lastDecrease >= DECREASE_INTERVAL:
+            self.lastDecrease = now
+            self.limit = max(self.minimum,self.limit * ratio)
+
+    def asDict(self):
+        with self.cond:
+            return {'limit':int(self.limit),'inflight':self.inflight,'overloads':self.overloads,'waited':self.waited}
+
+class RequestLimiter(object):
+    """AdaptiveLimiter per class of requests shared by all users of ForemanClient"""
+
+    def __init__(self,limits=None):
+        """Creates new instance
+
+        :param limits: dict of request class to max concurrency overriding LIMITS
+        """
+        limits = dict(LIMITS,**(limits or {}))
+        self.limiters = dict((name,AdaptiveLimiter(name,int(maximum),latency=name not in SLOW_CLASSES)) for name,maximum in limits.items())
+
+    def forRequest(self,method,path):
+        return self.limiters[requestClass(method,path)]
+
+    def asDict(self):
+        return dict((name,limiter.asDict()) for name,limiter in self.limiters.items())
@@ -0,0 +1,72 @@
+"""This module contains retry policy shared by requests to foreman
+
+"""
+import logging, random, time
+from .limiter import RETRY_MESSAGE
+
+# max number of attempts of request failing with transient error
+RETRY_ATTEMPTS = 5
+# backoff before n-th retry is random up to min(cap, base * 2^n) seconds (full jitter)
+RETRY_BASE = 1
+RETRY_CAP = 30
+# foreman asking to try again later is obeyed up to this many seconds
+RETRY_LATER_TIMEOUT = 10*60
+
+# methods safe to send again when outcome of previous attempt is unknown
+IDEMPOTENT = ('GET','HEAD','PUT','DELETE')
+
+# request was rejected before foreman processed it (retry is always safe)
+REJECTED = 'rejected'
+# foreman asks to try again in a few minutes (i.e. power on while oVirt is busy)
+LATER = 'later'
+# request may or may not have been processed (gateway error, connection lost)
+UNCERTAIN = 'uncertain'
+
+def failureReason(status=None,text='',exception=None):
+    """Returns REJECTED, LATER, UNCERTAIN or None when failure (or success) is not transient"""
+    if exception is not None:
+        return UNCERTAIN
+    if status in (429,503):
+        return REJECTED
+    if status in (502,504):
+        return UNCERTAIN
+    if status == 500 and text.find(RETRY_MESSAGE) >= 0:
+        return LATER
+
+class RetryPolicy(object):
+    """
+    Decides whether and when failed request is sent again. Rejected requests are retried always,
+    requests with unknown outcome only when their method is idempotent or caller can verify the
+    outcome (i.e. whether host got created). Every retry is logged as single line of key=value pairs.
+    """
+    def __init__(self,attempts=RETRY_ATTEMPTS,base=RETRY_BASE,cap=RETRY_CAP,laterTimeout=RETRY_LATER_TIMEOUT):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.laterTimeout = laterTimeout
+        self.log = logging.getLogger('Foreman.retry')
+
+    def backoff(self,attempt):
+        return random.uniform(0,min(self.cap,self.base * 2 ** attempt))
+
+    def next(self,method,resource,attempt,started,reason,status=None,exception=None,verifiable=False):
+        """Returns seconds to wait before next attempt or None when request must not be retried
+
+        :param attempt: number of attempts made so far
+        :param started: time of first attempt
+        :param reason: result of failureReason()
+        :param verifiable: caller checks outcome of uncertain attempt before sending request again
+        """
+        if reason is None:
+            return None
+        if reason == UNCERTAIN and method not in IDEMPOTENT and not verifiable:
+            return None
+        if reason == LATER:
+            if time.time() - started > self.laterTimeout:
+                return None
+        elif attempt >= self.attempts:
+            return None
+        delay = self.backoff(attempt)
+        self.log.warning('retry method=%s resource=%s attempt=%d reason=%s status=%s error=%s delay=%.1fs',
+            method,resource,attempt,reason,status,exception and type(exception).__name__,delay)
+        return delay
@@ -0,0 +1,161 @@
+"""This module contains scheduler running host tasks in order given by dependencies among hosts
+
+"""
+import time
+from threading import Condition
+from concurrent.futures import ThreadPoolExecutor, Future
+from .defaults import PARALLEL
+from .util import TaskResult
+from .trace import tracer, WAIT
+
+# host was created in foreman (its IP is known)
+CREATED = 'created'
+# task of host has finished
+DONE = 'done'
+
+class DependencyException(Exception):
+    pass
+
+class DependencyScheduler(object):
+    """
+    Runs task of each node as soon as all its prerequisites are satisfied. Prerequisite is a pair
+    (node name, milestone), where milestone is either CREATED or DONE. DONE is reached when node's task
+    returns non-null value, CREATED is reached either by calling mark() from within task or by reaching DONE.
+    Nodes with failed prerequisites are not run at all.
+
+    Task may return a Future when the rest of its work is waiting (i.e. for host to get installed), its worker
+    is released then and node finishes once the future is done. Only tasks doing work take workers.
+    """
+    def __init__(self,parallel=PARALLEL):
+        self.parallel = parallel
+        self.nodes = {}
+        self.order = []
+        self.cond = Condition()
+        # nodes which state changed since scheduler looked at their dependants
+        self.changed = []
+
+    def add(self,name,target=None,args=(),deps=()):
+        """Adds node, node without target is a barrier reaching DONE once its prerequisites are satisfied"""
+        if name in self.nodes:
+            raise DependencyException('Node %s added twice' % name)
+        self.nodes[name] = {'target':target,'args':args,'deps':list(deps),'reached':set(),'state':'waiting'}
+        self.order.append(name)
+
+    def mark(self,name,milestone):
+        """Marks node as having reached milestone, wakes up nodes waiting for it"""
+        with self.cond:
+            self.nodes[name]['reached'].add(milestone)
+            self.changed.append(name)
+            self.cond.notify_all()
+
+    def _dependants(self):
+        """Returns dict of node name to list of nodes depending on it"""
+        dependants = dict((name,[]) for name in self.order)
+        for name in self.order:
+            for dep in set(dep for dep,m in self.nodes[name]['deps']):
+                dependants[dep].append(name)
+        return dependants
+
+    def _check(self):
+        for name in self.order:
+            for dep,milestone in self.nodes[name]['deps']:
+                if dep not in self.nodes:
+                    raise DependencyException('%s depends on unknown node %s' % (name,dep))
+        # Kahn's algorithm to detect cycles
+        dependants = self._dependants()
+        incoming = dict((name,len(set(dep for dep,m in self.nodes[name]['deps']))) for name in self.order)
+        ready = [name for name,count in incoming.items() if count == 0]
+        visited = 0
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for d in dependants[name]:
+                incoming[d] -= 1
+                if incoming[d] == 0:
+                    ready.append(d)
+        if visited != len(self.order):
+            cycle = sorted(name for name,count in incoming.items() if count > 0)
+            raise DependencyException('Dependency cycle detected among %s' % ', '.join(cycle))
+
+    def _status(self,node):
+        """Returns 'ready', 'blocked' (some prerequisite failed) or 'waiting'"""
+        for dep,milestone in node['deps']:
+            prereq = self.nodes[dep]
+            if milestone in prereq['reached'] or DONE in prereq['reached']:
+                continue
+            if prereq['state'] in ('failed','skipped'):
+                return 'blocked'
+            return 'waiting'
+        return 'ready'
+
+    def run(self):
+        """Runs all nodes, returns dict of node name to TaskResult"""
+        self._check()
+        results = {}
+        dependants = self._dependants()
+        t0 = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.parallel)
+
+        def finished(name,result):
+            with self.cond:
+                node = self.nodes[name]
+                results[name] = result
+                node['state'] = 'done' if result.ok else 'failed'
+                if result.ok:
+                    node['reached'].update([CREATED,DONE])
+                self.changed.append(name)
+                self.cond.notify_all()
+
+        def deferred(name,future,t0):
+            args = self.nodes[name]['args']
+            if future.exception() is not None:
+                finished(name,TaskResult(args,exception=future.exception(),duration=time.time() - t0))
+            else:
+                finished(name,TaskResult(args,result=future.result(),duration=time.time() - t0))
+
+        def task(name):
+            node = self.nodes[name]
+            t0 = time.time()
+            try:
+                result = node['target'](*node['args'])
+            except Exception as e:
+                finished(name,TaskResult(node['args'],exception=e,duration=time.time() - t0))
+                return
+            if isinstance(result,Future):
+                result.add_done_callback(lambda future: deferred(name,future,t0))
+            else:
+                finished(name,TaskResult(node['args'],result=result,duration=time.time() - t0))
+
+        def evaluate(name):
+            node = self.nodes[name]
+            if node['state'] != 'waiting':
+                return
+            status = self._status(node)
+            if status == 'blocked':
+                node['state'] = 'skipped'
+                results[name] = TaskResult(node['args'],exception=DependencyException('prerequisite of %s failed' % name))
+                self.changed.append(name)
+            elif status == 'ready' and node['target'] is None:
+                node['state'] = 'done'
+                node['reached'].update([CREATED,DONE])
+                results[name] = TaskResult(node['args'],result=True)
+                self.changed.append(name)
+            elif status == 'ready':
+                if node['deps']:
+                    tracer.add('wait prerequisites',WAIT,t0,time.time(),track=name)
+                node['state'] = 'running'
+                executor.submit(task,name)
+
+        try:
+            with self.cond:
+                for name in self.order:
+                    evaluate(name)
+                while len(results) < len(self.order):
+                    if not self.changed:
+                        self.cond.wait()
+                    while self.changed:
+                        for d in dependants[self.changed.pop()]:
+                            evaluate(d)
+        finally:
+            executor.shutdown()
+        return results
@@ -0,0 +1,230 @@
+"""This module contains tracer recording spans of lifecycle phases, host steps, foreman requests and probes
+
+Tracing is off unless enabled by ``--trace FILE``. Recorded spans are then written in Chrome trace-event
+format (open it in chrome://tracing or https://ui.perfetto.dev) and summarized by category.
+"""
+import functools, json, re, sys, time
+from threading import Lock, current_thread, local
+try:
+    import contextvars
+except ImportError:
+    # python 2.x, tracks are then kept per thread only
+    contextvars = None
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+from contextlib import contextmanager
+
+# code flag of coroutine functions (inspect.CO_COROUTINE), inspect itself is slow to import
+CO_COROUTINE = 0x80
+
+# lifecycle method of Uberforeman (validateSetup, install, start, ...)
+PHASE = 'phase'
+# step of single host within phase (installHost, startHost, ...)
+HOST = 'host'
+# request to foreman
+HTTP = 'http'
+# readiness probe of host
+PROBE = 'probe'
+# polling of orchestration tasks
+TASK = 'task'
+# waiting for host to get installed, for power on or for prerequisites
+WAIT = 'wait'
+
+CATEGORIES = (PHASE,HOST,HTTP,PROBE,TASK,WAIT)
+
+def requestName(method,url):
+    """Returns name of request span, ids in path are replaced so same endpoints share the name"""
+    path = urlparse(url).path
+    path = re.sub('/orchestration/[^/]+','/orchestration/:uuid',path)
+    return '%s %s' % (method,re.sub('/[0-9]+(?=/|$)','/:id',path))
+
+def _covered(intervals):
+    """Returns total length of union of (start,end) intervals"""
+    total = 0
+    end = None
+    for s,e in sorted(intervals):
+        if end is None or s > end:
+            total += e - s
+            end = e
+        elif e > end:
+            total += e - end
+            end = e
+    return total
+
+class Tracer(object):
+    """
+    Records spans (name, category, start, end, args) on tracks. Track is a row in the timeline,
+    host steps run on track of their host and spans nested in them (requests, probes, waits) inherit it,
+    everything else is recorded on track of current thread.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.lock = Lock()
+        self.spans = []
+        self.t0 = time.time()
+        if contextvars:
+            self._track = contextvars.ContextVar('uberforeman_track',default=None)
+        else:
+            self._local = local()
+
+    def enable(self,path=None):
+        """Starts tracing, spans are written to path by finish()"""
+        self.enabled = True
+        self.path = path
+        self.t0 = time.time()
+
+    def finish(self):
+        """Writes trace file and shows summary, does nothing unless tracing is enabled"""
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.path:
+            self.save(self.path)
+        self.showSummary()
+
+    def currentTrack(self):
+        if contextvars:
+            track = self._track.get()
+        else:
+            track = getattr(self._local,'track',None)
+        return track or current_thread().name
+
+    def _enter(self,track):
+        if contextvars:
+            return self._track.set(track)
+        previous = getattr(self._local,'track',None)
+        self._local.track = track
+        return previous
+
+    def _exit(self,token):
+        if contextvars:
+            self._track.reset(token)
+        else:
+            self._local.track = token
+
+    def add(self,name,category,start,end,track=None,**args):
+        """Records span which has already finished"""
+        if not self.enabled:
+            return
+        span = {'name':name,'cat':category,'start':start,'end':end,'track':track or self.currentTrack(),'args':args}
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self,name,category,track=None,**args):
+        """Records span of with block, yields dict of span args which can be extended within the block
+
+        :param track: runs block on given track (host name), nested spans are recorded on it as well
+        """
+        if not self.enabled:
+            yield args
+            return
+        token = track and self._enter(track)
+        start = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            if track:
+                self._exit(token)
+            self.add(name,category,start,end,track,**args)
+
+    def hostStep(self,target):
+        """Wraps target(vm,...) so each call is recorded as HOST span on track of its host"""
+        if not self.enabled or getattr(target,'__code__',None) and target.__code__.co_flags & CO_COROUTINE:
+            # async engine records host steps itself
+            return target
+        name = target.__name__.lstrip('_')
+
+        @functools.wraps(target)
+        def wrapper(vm,*args):
+            with self.span(name,HOST,track=vm['name']):
+                return target(vm,*args)
+        return wrapper
+
+    def chromeTrace(self):
+        """Returns spans as Chrome trace-event document. Overlapping spans which do not nest (async engine
+        or parallel page fetches) are spread over several rows of their track"""
+        with self.lock:
+            spans = sorted(self.spans,key=lambda s: (s['start'],-s['end']))
+        rows = {}
+        tids = {}
+        events = []
+        for span in spans:
+            stacks = rows.setdefault(span['track'],[])
+            for row,stack in enumerate(stacks):
+                while stack and stack[-1] <= span['start']:
+                    stack.pop()
+                if not stack or span['end'] <= stack[-1]:
+                    break
+            else:
+                stack = []
+                stacks.append(stack)
+                row = len(stacks) - 1
+            stack.append(span['end'])
+            key = (span['track'],row)
+            if key not in tids:
+                tids[key] = len(tids) + 1
+                label = row and '%s (%d)' % (span['track'],row + 1) or span['track']
+                events.append({'ph':'M','name':'thread_name','pid':1,'tid':tids[key],'args':{'name':label}})
+            events.append({
+                'name':span['name'],
+                'cat':span['cat'],
+                'ph':'X',
+                'ts':int((span['start'] - self.t0) * 1000000),
+                'dur':int((span['end'] - span['start']) * 1000000),
+                'pid':1,
+                'tid':tids[key],
+                'args':span['args']})
+        return {'traceEvents':events,'displayTimeUnit':'ms'}
+
+    def save(self,path):
+        with open(path,'w') as fd:
+            json.dump(self.chromeTrace(),fd,default=str)
+
+    def summary(self):
+        """Returns list of dicts with category, spans, total (sum of span durations), covered (wall time
+        covered by at least one span of category), max and top (3 span names with most covered time)"""
+        with self.lock:
+            spans = list(self.spans)
+        rows = []
+        for category in CATEGORIES:
+            cat = [s for s in spans if s['cat'] == category]
+            if not cat:
+                continue
+            byName = {}
+            for s in cat:
+                byName.setdefault(s['name'],[]).append((s['start'],s['end']))
+            top = sorted(((_covered(i),len(i),name) for name,i in byName.items()),reverse=True)[:3]
+            rows.append({
+                'category':category,
+                'spans':len(cat),
+                'total':sum(s['end'] - s['start'] for s in cat),
+                'covered':_covered([(s['start'],s['end']) for s in cat]),
+                'max':max(s['end'] - s['start'] for s in cat),
+                'top':[{'name':name,'spans':count,'covered':covered} for covered,count,name in top]})
+        return rows
+
+    def showSummary(self,out=sys.stderr):
+        wall = time.time() - self.t0
+        out.write('Trace summary (wall time %.1fs, covered = wall time spent in at least one span)\n' % wall)
+        out.write('%-8s %8s %10s %10s %8s %9s\n' % ('category','spans','total','covered','% wall','max'))
+        for row in self.summary():
+            out.write('%-8s %8d %9.1fs %9.1fs %7.0f%% %8.2fs\n' % (row['category'],row['spans'],row['total'],row['covered'],
+                wall and row['covered'] / wall * 100,row['max']))
+            for top in row['top']:
+                out.write('  %-40s %6d spans %7.1fs covered\n' % (top['name'][:40],top['spans'],top['covered']))
+
+def tracedPhase(f):
+    """Decorator recording each call of lifecycle method as PHASE span"""
+    @functools.wraps(f)
+    def wrapper(*args,**kwargs):
+        with tracer.span(f.__name__,PHASE):
+            return f(*args,**kwargs)
+    return wrapper
+
+# tracer shared by whole process
+tracer = Tracer()
@@ -2,22 +2,29 @@
 
 __author__ = 'Libor Zoubek'
 __email__  = 'lzoubek@redhat.com'
+import time
+# startup cost shown by --timing is measured from here
+STARTED = time.time()
 import sys,os,re,signal
-import argparse,json,requests
+import argparse,json
 try:
     import configparser
 except:
     import ConfigParser as configparser
 
-from .controller import Uberforeman
-from .client import ForemanClient
-
-# disable urllib3 Unverified HTTPS warnings
-requests.packages.urllib3.disable_warnings()
+# modules importing requests (client, hostready, controller) are imported by run() once they are needed,
+# so --help and --dump do not pay for them
+from .defaults import PARALLEL
+from .cache import CACHE_DIR
+from .daemon import SOCKET_PATH
+from .trace import tracer
 
 def signal_handler(signal, frame):
     print('uberforeman was interrupted, will now exit')
-    sys.exit(130)
+    sys.stdout.flush()
+    tracer.finish()
+    # worker threads may be waiting for hosts to get installed, do not wait for them
+    os._exit(130)
 signal.signal(signal.SIGINT, signal_handler)
 
 def filterSetupJson(fd):
@@ -28,79 +35,291 @@ def filterSetupJsonStr(text):
     """Filters out possible comments in setup JSON file"""
     return ''.join(list(filter(lambda line: re.search('^[ \t]*#',line) == None,text.split('\n'))))
 
-def main():
-    parser = argparse.ArgumentParser()
+def loadSetup(path):
+    """Returns setup loaded from file or http(s) URL"""
+    if path.find('http://') == 0 or path.find('https://') == 0:
+        import requests
+        r = requests.get(path)
+        if r.status_code != 200:
+            raise Exception('Unable to GET %s, server returned %d : %s'%(path,r.status_code,r.text))
+        return json.loads(filterSetupJsonStr(r.text))
+    with open(path,'r') as setup:
+        return json.loads(filterSetupJson(setup))
+
+class Timing(object):
+    """Startup milestones shown by --timing, times are relative to STARTED"""
+
+    def __init__(self):
+        self.marks = []
+
+    def mark(self,label,when=None):
+        self.marks.append((label,when or time.time()))
+
+    def show(self,out=sys.stderr):
+        out.write('Startup timing (seconds since start)\n')
+        for label,when in sorted(self.marks,key=lambda m: m[1]):
+            out.write('  %-24s %7.3fs\n' % (label,when - STARTED))
+
+def createParser():
+    parser = argparse.ArgumentParser(epilog='Run "uberforeman serve" to keep a daemon with warm connections and caches, commands are then executed by it.')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--status', action='store_true', help='Show status of your setup')
     group.add_argument('--install', action='store_true', help='Install setup')
+    group.add_argument('--resume', action='store_true', help='Resume interrupted install, trusting hosts journaled as created/installed')
     group.add_argument('--destroy', action='store_true', help='Destroy setup (delete all VMs)')
     group.add_argument('--reinstall', action='store_true', help='Rebuild setup (keep VMs but install again)')
     group.add_argument('--start', action='store_true', help='Start all VMs in setup (keep order)')
     group.add_argument('--stop', action='store_true', help='Stop all VMs in setup')
     group.add_argument('--restart', action='store_true', help='Restarts setup (same as --stop and --start)')
     group.add_argument('--force-install', action='store_true', help='Forces installation (same as --destroy and --install)')
+    group.add_argument('--plan', action='store_true', help='Show actions needed to bring foreman in sync with setup')
+    group.add_argument('--apply', action='store_true', help='Run only actions needed to bring foreman in sync with setup (see --plan)')
     group.add_argument('--dump', action='store_true', help='Prints setup JSON file after applying all defaults')
-    parser.add_argument('setup',help='Setup file')
+    group.add_argument('--watch', action='store_true', help='Watch status of your setup until interrupted, with --format json print JSON event per change')
+    parser.add_argument('setup',nargs='+',help='Setup file, several files or directories with --batch')
+    parser.add_argument('--batch', action='store_true', help='Run action on all given setups (*.json files of directories) at once, --parallel then limits hosts of all setups together')
     parser.add_argument('--user', help='Your foreman username',default=None)
     parser.add_argument('--password', help='Your foreman password',default=None)
     parser.add_argument('--foreman', help='Your foreman URL',default=None)
-    args = parser.parse_args()
-    foreman = user = passw = hostDefaults = None
+    parser.add_argument('--parallel', type=int, metavar='N', help='Max number of hosts sending requests to foreman in parallel, hosts waiting to get installed do not count (default %d)' % PARALLEL, default=PARALLEL)
+    parser.add_argument('--format', choices=['text','json'], help='Output format of --status, --plan, --watch and --batch (default text)', default='text')
+    parser.add_argument('--engine', choices=['thread','async'], help='Engine driving install/start/stop/destroy, async engine requires aiohttp (default thread)', default='thread')
+    parser.add_argument('--refresh-cache', action='store_true', help='Download foreman catalogs again instead of using local cache')
+    parser.add_argument('--trace', metavar='FILE', help='Record timeline of phases, host steps and requests to FILE (Chrome trace format) and show summary')
+    parser.add_argument('--timing', action='store_true', help='Show time to first foreman request and total startup cost')
+    parser.add_argument('--socket', metavar='PATH', help='Control socket of uberforeman daemon (default %s)' % SOCKET_PATH, default=SOCKET_PATH)
+    parser.add_argument('--no-daemon', action='store_true', help='Run in this process even if uberforeman daemon is running')
+    return parser
+
+def parseArgs(argv=None):
+    parser = createParser()
+    args = parser.parse_args(argv)
+    if args.batch:
+        if args.dump or args.watch:
+            parser.error('--dump and --watch do not support --batch')
+        if args.engine != 'thread':
+            parser.error('--batch runs thread engine only')
+    elif len(args.setup) > 1:
+        parser.error('use --batch to run several setups')
+    else:
+        args.setup = args.setup[0]
+    return args
+
+def main():
+    if sys.argv[1:2] == ['serve']:
+        from .daemon import serve
+        return serve(sys.argv[2:])
+    args = parseArgs()
+    # --trace and --timing measure this process, --dump does not talk to foreman at all,
+    # --watch would keep daemon busy forever
+    if not (args.no_daemon or args.dump or args.trace or args.timing or args.batch or args.watch):
+        from .daemon import forward
+        code = forward(args.socket,sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    if args.trace:
+        tracer.enable(args.trace)
+    try:
+        run(args)
+    finally:
+        tracer.finish()
+
+def readConfig(args):
+    """Returns dict of foreman url, user, password, hostDefaults, cache and limits settings,
+    options given on command line take precedence over ~/.uberforeman"""
+    settings = {'url':None,'user':None,'password':None,'hostDefaults':None,'cacheDir':CACHE_DIR,'cacheTTL':{},'limits':{}}
     config = configparser.ConfigParser()
     try:
         config.read(os.path.join(os.environ['HOME'],'.uberforeman'))
-        user = config.get('Login','username')
-        passw = config.get('Login','password')
-        foreman = config.get('Foreman','url')
-        hostDefaults = dict(config.items('Host Defaults'))
+        settings['user'] = config.get('Login','username')
+        settings['password'] = config.get('Login','password')
+        settings['url'] = config.get('Foreman','url')
+        settings['hostDefaults'] = dict(config.items('Host Defaults'))
     except:
         pass
-    
+    if config.has_section('Cache'):
+        for key,value in config.items('Cache'):
+            if key == 'directory':
+                settings['cacheDir'] = os.path.expanduser(value)
+            elif key.find('ttl_') == 0:
+                settings['cacheTTL'][key[4:]] = int(value)
+    if config.has_section('Limits'):
+        for key,value in config.items('Limits'):
+            settings['limits'][key] = int(value)
     if args.user:
-        user = args.user
+        settings['user'] = args.user
     if args.password:
-        passw = args.password
+        settings['password'] = args.password
     if args.foreman:
-        foreman = args.foreman
-    if not user or not foreman:
-        print('No user or foreman URL specified, use either --user or create $HOME/.uberforeman with following conent:\n[Login]\nusername=you\npassword=your\n[Foreman]\nurl=https://your.foreman\n[Host Defaults]\n#cluster=userspace')
+        settings['url'] = args.foreman
+    return settings
+
+def createClient(settings,parallel=PARALLEL,refresh=False):
+    """Returns ForemanClient for given settings (see readConfig)"""
+    import requests
+    from .cache import CatalogCache
+    from .client import ForemanClient, PAGE_PARALLEL
+    # disable urllib3 Unverified HTTPS warnings
+    requests.packages.urllib3.disable_warnings()
+    cache = CatalogCache(settings['url'],settings['user'],settings['cacheDir'],settings['cacheTTL'],refresh)
+    return ForemanClient(settings['url'],settings['user'],settings['password'],poolSize=parallel + PAGE_PARALLEL,cache=cache,limits=settings['limits'])
+
+def perform(fc,args,timing=None):
+    """Validates setup and runs action given by args, exits when setup is not valid
+
+    :param timing: Timing shown once setup is validated
+    """
+    from .controller import SetupValidationException
+    fc.resume = args.resume
+    fc.parallel = args.parallel
+    try:
+        fc.prefetch()
+        fc.validateSetup()
+    except SetupValidationException:
         sys.exit(1)
-    if not passw:
-        import getpass
-        passw = getpass.getpass()
-    foreman = ForemanClient(foreman,user,passw)
-    foreman.testConnection()
-    setupContent = ''
-    if args.setup.find('http://') == 0 or args.setup.find('https://') == 0:
-        r = requests.get(args.setup)
-        if r.status_code != 200:
-            raise Exception('Unable to GET %s, server returned %d : %s'%(args.setup,r.status_code,r.text))
-        setupContent = filterSetupJsonStr(r.text)
-    else:
-        with open(args.setup,'r') as setup:
-            setupContent = filterSetupJson(setup)
-    
-    fc = Uberforeman(foreman,json.loads(setupContent),os.path.basename(args.setup),hostDefaults)
-    fc.validateSetup()
-    if args.dump:
-        fc.dump()
+    if timing:
+        timing.mark('setup validated')
+        if fc.foreman.stats.first:
+            timing.mark('first request',fc.foreman.stats.first)
+        timing.show()
+    execute(fc,args)
+
+def execute(fc,args,result=None):
+    """Runs action given by args on validated setup
+
+    :param result: dict status and plan are stored to instead of being printed as JSON (--batch collects
+    them to single document)
+    """
+    engine = fc
+    collect = result is not None and args.format == 'json'
+    if args.engine == 'async':
+        from .aio import AsyncEngine
+        engine = AsyncEngine(fc,foremanLimit=args.parallel)
     if args.status:
-        fc.status()
-    if args.install:
-        fc.install()
+        if collect:
+            result['status'] = fc.facts()
+        else:
+            fc.status(args.format)
+    if args.watch:
+        from .watch import Watcher
+        Watcher(fc,args.format).run()
+    if args.plan:
+        if collect:
+            result['plan'] = fc.planActions(fc.plan())
+        else:
+            fc.showPlan(fc.plan(),args.format)
+    if args.apply:
+        fc.apply(engine)
+    if args.install or args.resume:
+        engine.install()
     if args.stop:
-        fc.stop()
+        engine.stop()
     if args.start:
-        fc.start()
+        engine.start()
     if args.restart:
-        fc.stop()
-        fc.start()
+        engine.stop()
+        engine.start()
     if args.destroy:
-        fc.destroy()
+        engine.destroy()
     if args.reinstall:
-        fc.enableBuild()
-        fc.stop()
-        fc.start()
+        engine.enableBuild()
+        engine.stop()
+        engine.start()
     if args.force_install:
-        fc.destroy()
-        fc.install()
+        engine.destroy()
+        engine.install()
+
+def batchSetups(paths):
+    """Returns setup files of --batch, directories are expanded to *.json files they contain"""
+    setups = []
+    for path in paths:
+        if os.path.isdir(path):
+            setups.extend(sorted(os.path.join(path,name) for name in os.listdir(path) if name.endswith('.json')))
+        else:
+            setups.append(path)
+    return setups
+
+def runBatch(foreman,args,settings):
+    """Runs action on all setups of --batch at once, all of them share foreman client (its catalogs, connections
+    and request limits) and args.parallel slots for hosts. Exits with 1 unless action succeeded on all setups"""
+    from threading import BoundedSemaphore
+    from .controller import Uberforeman
+    from .journal import Journal, setupKey
+    from .util import run_parallel
+    paths = batchSetups(args.setup)
+    slots = BoundedSemaphore(args.parallel)
+
+    def runSetup(path):
+        t0 = time.time()
+        result = {'setup':path,'hosts':0,'result':'ok','failed':[],'error':None}
+        try:
+            fc = Uberforeman(foreman,loadSetup(path),os.path.basename(path),settings['hostDefaults'],args.parallel,Journal.forSetup(path),setupKey(path))
+            fc.slots = slots
+            fc.resume = args.resume
+            result['hosts'] = len(fc.setup['hosts'])
+            fc.prefetch()
+            fc.validateSetup()
+            execute(fc,args,result)
+            result['failed'] = sorted(set(fc.failed))
+            if fc.failed:
+                result['result'] = 'failed'
+        except Exception as e:
+            result['result'] = 'error'
+            result['error'] = str(e)
+        result['duration'] = round(time.time() - t0,1)
+        return result
+
+    results = [r.result for r in run_parallel(runSetup,[(path,) for path in paths],len(paths))]
+    showBatch(results,args.format)
+    if [r for r in results if r['result'] != 'ok']:
+        sys.exit(1)
+
+def showBatch(results,format='text'):
+    """Prints results of --batch, one line per setup or single JSON document with status or plan of each setup"""
+    if format == 'json':
+        print(json.dumps(results,indent=2))
+        return
+    print('%-40s %6s %-7s %8s  %s' % ('setup','hosts','result','time','failed hosts / error'))
+    for r in results:
+        print('%-40s %6d %-7s %7.1fs  %s' % (r['setup'][-40:],r['hosts'],r['result'],r['duration'],r['error'] or ', '.join(r['failed'])))
+
+def run(args):
+    timing = Timing()
+    timing.mark('imports')
+    settings = readConfig(args)
+    from .controller import Uberforeman
+    from .journal import Journal, setupKey
+    if args.dump:
+        # applying defaults needs no foreman
+        Uberforeman(None,loadSetup(args.setup),os.path.basename(args.setup),settings['hostDefaults'],args.parallel).dump()
+        if args.timing:
+            timing.mark('dumped')
+            timing.show()
+        return
+    if not settings['user'] or not settings['url']:
+        print('No user or foreman URL specified, use either --user or create $HOME/.uberforeman with following conent:\n[Login]\nusername=you\npassword=your\n[Foreman]\nurl=https://your.foreman\n[Host Defaults]\n#cluster=userspace')
+        sys.exit(1)
+    if not settings['password']:
+        import getpass
+        settings['password'] = getpass.getpass()
+    from concurrent.futures import ThreadPoolExecutor, wait
+    foreman = createClient(settings,args.parallel,args.refresh_cache)
+    timing.mark('client ready')
+    if args.batch:
+        foreman.testConnection()
+        return runBatch(foreman,args,settings)
+    # connection is tested and catalogs are loaded while setup is being loaded
+    executor = ThreadPoolExecutor(max_workers=4)
+    try:
+        connected = executor.submit(foreman.testConnection)
+        prefetched = foreman.prefetch(executor)
+        fc = Uberforeman(foreman,loadSetup(args.setup),os.path.basename(args.setup),settings['hostDefaults'],args.parallel,Journal.forSetup(args.setup),setupKey(args.setup))
+        timing.mark('setup loaded')
+        connected.result()
+        timing.mark('connection tested')
+        # failed prefetch is not fatal, validation loads catalog again and reports the error
+        wait(prefetched)
+        timing.mark('catalogs loaded')
+    finally:
+        executor.shutdown(wait=False)
+    perform(fc,args,args.timing and timing or None)
@@ -1,28 +1,76 @@
-import threading,time
-try:
-    import queue
-except:
-    # python 2.x fallback
-    import Queue as queue
-
-def run_parallel(target, args_list):
-    result = queue.Queue()
-    # wrapper to collect return value in a Queue
-    def task_wrapper(*args):
-        result.put(target(*args))
-    threads = [threading.Thread(target=task_wrapper, args=args) for args in args_list]
-    for t in threads:
-        t.daemon = True
-        t.start()
-    for t in threads:
-        while t.isAlive():
-            time.sleep(0.1)
-    return result
-
-def run_parallel_bool(target,args_list):
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from .defaults import PARALLEL
+
+def getOrFail(f):
+    def wrap(*args,**kwargs):
+        res = f(*args,**kwargs)
+        if res:
+            if len(res) == 1:
+                return res[0]
+        raise Exception('Unable to find %s by criteria %s' % (f.__name__,str(kwargs)))
+    return wrap
+
+def getOrNone(f):
+    def wrap(*args,**kwargs):
+        res = f(*args,**kwargs)
+        if res:
+            if len(res) == 1:
+                return res[0]
+    return wrap
+
+def chain(future,f):
+    """Returns Future of f(result of future), called once future is done. Exception of future
+    (or raised by f) is passed to returned Future"""
+    chained = Future()
+
+    def done(source):
+        try:
+            chained.set_result(f(source.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(done)
+    return chained
+
+class TaskResult(object):
+    """Outcome of single task executed by run_parallel"""
+
+    def __init__(self,args,result=None,exception=None,duration=0):
+        self.args = args
+        self.result = result
+        self.exception = exception
+        self.duration = duration
+
+    @property
+    def ok(self):
+        """Task succeeded when it did not raise and returned non-null value"""
+        return self.exception is None and self.result is not None
+
+    def __repr__(self):
+        return 'TaskResult(args=%r, result=%r, exception=%r, duration=%.2fs)' % (self.args,self.result,self.exception,self.duration)
+
+def run_parallel(target, args_list, parallel=PARALLEL):
+    """Runs target for each args tuple in args_list using at most ``parallel`` threads.
+
+    :return: list of TaskResult in the same order as args_list
+    """
+    args_list = list(args_list)
+    if len(args_list) == 0:
+        return []
+
+    def task_wrapper(args):
+        t0 = time.time()
+        try:
+            return TaskResult(args,result=target(*args),duration=time.time() - t0)
+        except Exception as e:
+            return TaskResult(args,exception=e,duration=time.time() - t0)
+
+    executor = ThreadPoolExecutor(max_workers=max(1,min(parallel,len(args_list))))
+    try:
+        return list(executor.map(task_wrapper,args_list))
+    finally:
+        executor.shutdown()
+
+def run_parallel_bool(target, args_list, parallel=PARALLEL):
     """"Target function must return non-null value on success to get True as result"""
-    result = run_parallel(target,args_list)
-    while not result.empty():
-        if result.get() == None:
-            return False
-    return True
+    return all(r.ok for r in run_parallel(target,args_list,parallel))
@@ -0,0 +1,169 @@
+"""This module contains incremental watch of setup status
+
+"""
+import sys, time, json
+from .trace import tracer, PHASE
+
+# hosts whose state is changing (building, installing, powering on/off) are refreshed this often (seconds)
+WATCH_MIN = 5
+# interval of stable hosts doubles with every refresh which found no change, up to this many seconds
+WATCH_MAX = 300
+# watch loop wakes up this often to refresh hosts which are due (seconds)
+WATCH_TICK = 1
+# facts compared between refreshes, changes of other facts are not reported
+WATCHED = ('exists','building','state','power','image','outOfSync')
+
+def isChanging(facts):
+    """Returns True when host is in transient state and is expected to change soon"""
+    if not facts['exists']:
+        return False
+    # foreman clears build flag once host is built, install reported by host itself is in progress as well
+    if facts['building'] or facts['state'].find('INSTALLING') == 0:
+        return True
+    # powering on/off is transient, any other steady state (i.e. N/A of host without readiness service) is not
+    return facts['power'] not in ('up','down')
+
+def changes(old,new):
+    """Returns dict of watched fact to [old,new] value for facts which differ"""
+    result = {}
+    for key in WATCHED:
+        if old.get(key) != new.get(key):
+            result[key] = [old.get(key),new.get(key)]
+    return result
+
+class Watcher(object):
+    """
+    Keeps status of all hosts of validated setup in memory and refreshes only hosts which are due. Changing
+    hosts are refreshed every WATCH_MIN seconds, interval of host doubles with each refresh which found
+    no change (up to WATCH_MAX), any change brings it back to WATCH_MIN. Hosts missing in foreman are looked
+    up together by single search.
+    """
+    def __init__(self,uf,format='text',out=sys.stdout,minimum=WATCH_MIN,maximum=WATCH_MAX):
+        """Creates new instance
+
+        :param uf: Uberforeman with validated setup
+        :param format: 'text' renders table of hosts, 'json' prints JSON change event per line
+        """
+        self.uf = uf
+        self.format = format
+        self.out = out
+        self.minimum = minimum
+        self.maximum = maximum
+        self.hosts = dict((vm['name'],vm) for vm in uf.setup['hosts'])
+        self.facts = {}
+        self.interval = {}
+        self.due = {}
+        self.refreshes = 0
+
+    def _fqdn(self,vm):
+        return '%s.%s' % (vm['name'],vm['domain'])
+
+    def _refreshRemote(self,vm):
+        """Reloads foreman state of existing host, returns False when host was deleted meanwhile"""
+        r = self.uf.foreman.request('GET','/api/hosts/%d' % vm['status']['remote']['id'])
+        if r.status_code == 404:
+            with self.uf.lock:
+                vm['status']['remote'] = None
+                vm.pop('ip',None)
+            return False
+        if r.status_code != 200:
+            raise Exception('Unable to refresh %s, server returned %d : %s' % (vm['name'],r.status_code,r.text))
+        with self.uf.lock:
+            vm['status']['remote'] = r.json()
+            vm['ip'] = vm['status']['remote']['ip']
+        return True
+
+    def _refreshHost(self,vm):
+        if vm['status']['remote']:
+            self._refreshRemote(vm)
+        return self.uf._hostFacts(vm)
+
+    def refresh(self,names):
+        """Refreshes given hosts, returns list of (name, facts) of refreshed hosts"""
+        hosts = [self.hosts[name] for name in names]
+        missing = [vm for vm in hosts if not vm['status']['remote']]
+        if missing:
+            remotes = self.uf.foreman.hostsByName([self._fqdn(vm) for vm in missing])
+            for vm in missing:
+                remote = remotes.get(self._fqdn(vm))
+                if remote:
+                    with self.uf.lock:
+                        vm['status']['remote'] = remote
+                        vm['ip'] = remote['ip']
+        results = self.uf._run(self._refreshHost,hosts)
+        refreshed = []
+        for r in results:
+            if r.exception:
+                self.uf.log.error('Failed to refresh %s : %s',r.args[0]['name'],r.exception)
+                # try again later, do not hammer foreman
+                self._schedule(r.args[0]['name'],False)
+            else:
+                refreshed.append((r.args[0]['name'],r.result))
+        self.refreshes += len(hosts)
+        return refreshed
+
+    def _schedule(self,name,changed):
+        facts = self.facts.get(name)
+        if changed or facts is None or isChanging(facts):
+            interval = self.minimum
+        else:
+            interval = min(self.maximum,self.interval.get(name,self.minimum) * 2)
+        self.interval[name] = interval
+        self.due[name] = time.time() + interval
+
+    def update(self,refreshed):
+        """Stores refreshed facts and schedules next refresh of hosts, returns list of change events"""
+        events = []
+        for name,facts in refreshed:
+            old = self.facts.get(name)
+            diff = changes(old or {},facts)
+            self.facts[name] = facts
+            if old is None:
+                events.append({'time':time.time(),'host':name,'event':'initial','facts':facts})
+            elif diff:
+                events.append({'time':time.time(),'host':name,'event':'changed','changes':diff})
+            self._schedule(name,old is not None and bool(diff))
+        return events
+
+    def poll(self):
+        """Refreshes hosts which are due, returns list of change events"""
+        now = time.time()
+        names = [name for name in self.hosts if self.due.get(name,0) <= now]
+        if not names:
+            return []
+        with tracer.span('watch refresh',PHASE,hosts=len(names)):
+            return self.update(self.refresh(names))
+
+    def render(self):
+        """Prints table of hosts, screen is cleared first when output is a terminal"""
+        if self.out.isatty():
+            self.out.write('\033[H\033[J')
+        self.out.write('Setup %s at %s, %d host refreshes so far\n' % (self.uf.name,time.strftime('%H:%M:%S'),self.refreshes))
+        self.out.write('%-24s %-6s %-8s %-5s %-40s %s\n' % ('host','order','building','power','state','next refresh'))
+        now = time.time()
+        for vm in self.uf.setup['hosts']:
+            facts = self.facts.get(vm['name'])
+            if facts is None:
+                continue
+            if facts['exists']:
+                row = (facts['building'] and 'yes' or 'no',facts['power'],facts['state'][:40])
+            else:
+                row = ('-','-','does not exist')
+            self.out.write('%-24s %-6d %-8s %-5s %-40s %ds\n' % ((vm['name'][:24],vm['order']) + row + (max(0,self.due[vm['name']] - now),)))
+        self.out.flush()
+
+    def emit(self,events):
+        for event in events:
+            self.out.write(json.dumps(event,default=dict) + '\n')
+        self.out.flush()
+
+    def run(self,tick=WATCH_TICK):
+        """Watches setup until interrupted or cancelled"""
+        while not self.uf.cancelled.is_set():
+            events = self.poll()
+            if self.format == 'json':
+                self.emit(events)
+            elif events or self.out.isatty():
+                # terminal shows countdown to next refresh, otherwise table is printed on change only
+                self.render()
+            time.sleep(tick)